@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import numpy as np
+import pandas as pd
+
+import organise_studies_by_funder
+import merge_studies_with_funder
+import ref_case_studies
+import corpus_cache
+from term_matching import TermMatcher
+from result_export import export_table, export_tables
+
+# Other global variables
+STUDIES_BY_FUNDER = "input/generated/list_of_studies_by_council.csv"
+UNITS_OF_ASSESSMENT = "input/raw/units_of_assessment.csv"
+UOA_SUMMARY = "outputs/summary_of_uoas.csv"
+REPORT_FILENAME = "outputs/benchmark_report.json"
+
+# The number of case studies in REF 2014, which is what a scale of 1 means
+REAL_CASE_STUDY_COUNT = 6637
+# The scales that are benchmarked by default. 10 and 100 can be asked for on the command line
+DEFAULT_SCALES = [0.1, 1]
+
+# Roughly how many words there are in each search place of a real case study
+PLACE_WORD_COUNTS = {'Title': 12, 'Summary of the impact': 110, 'Underpinning research': 550, 'Details of the impact': 800}
+# The fraction of real case studies in which any search term was found, and in which a funder was identified
+SOFTWARE_RELATED_FRACTION = 0.42
+FUNDED_FRACTION = 0.54
+
+# A stage has regressed if it is this much slower than in the baseline report,
+# unless it took less than MIN_REGRESSION_SECONDS, where timings are too noisy to judge
+REGRESSION_TOLERANCE = 0.2
+MIN_REGRESSION_SECONDS = 0.25
+
+FILLER_WORDS = ['the', 'research', 'impact', 'university', 'study', 'results', 'policy', 'public', 'new',
+                'development', 'work', 'was', 'and', 'of', 'in', 'to', 'a', 'for', 'with', 'by', 'this',
+                'health', 'industry', 'design', 'history', 'analysis', 'model', 'project', 'practice',
+                'led', 'national', 'international', 'government', 'community', 'evidence', 'use']
+
+
+def generate_corpus(case_study_count, search_terms, seed=0):
+    """Generate a synthetic corpus of case studies.
+
+    Text lengths are spread around those of the real case studies, around the
+    same fraction of studies contain search terms, and funders and Units of
+    Assessment are drawn from their distributions in the real data
+    :params: the number of case studies, a list of search terms and a random seed
+    :return: a dataframe laid out like all_ref_case_study_data.csv before cleaning
+    """
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({'Case Study Id': np.arange(1, case_study_count + 1)})
+
+    # Draw the Units of Assessment in the proportions of the real data, if it has been summarised
+    df_uoas = pd.read_csv(UNITS_OF_ASSESSMENT)
+    uoa_names = list(df_uoas['Unit of assessment'].str.strip())
+    uoa_weights = np.ones(len(uoa_names))
+    if os.path.exists(UOA_SUMMARY):
+        all_counts = pd.read_csv(UOA_SUMMARY, index_col=0)['all studies count']
+        uoa_weights = np.array([all_counts.get(ref_case_studies.normalise_uoa_name(name), 0) for name in uoa_names], dtype=float) + 1
+    df['Unit of Assessment'] = rng.choice(uoa_names, size=case_study_count, p=uoa_weights / uoa_weights.sum())
+
+    vocabulary = np.array(FILLER_WORDS)
+    software_related = rng.rand(case_study_count) < SOFTWARE_RELATED_FRACTION
+    for place, mean_words in PLACE_WORD_COUNTS.items():
+        lengths = np.maximum(1, rng.lognormal(np.log(mean_words), 0.4, size=case_study_count).astype(int))
+        texts = []
+        for length, related in zip(lengths, software_related):
+            words = list(vocabulary[rng.randint(len(vocabulary), size=length)])
+            if related:
+                # A few search terms per place, at random positions, with the odd capital and line break
+                for _ in range(rng.geometric(0.5)):
+                    words.insert(rng.randint(len(words) + 1), search_terms[rng.randint(len(search_terms))].title())
+            texts.append(' '.join(words).replace(' led ', ' led\n'))
+        df[place] = texts
+
+    # Take the funders of randomly chosen real case studies
+    df_studies_by_funder = pd.read_csv(STUDIES_BY_FUNDER)
+    funder_cols = [col for col in df_studies_by_funder.columns if col != 'Case Study Id']
+    funded = df_studies_by_funder[funder_cols].values[rng.randint(len(df_studies_by_funder), size=case_study_count)]
+    funded[rng.rand(case_study_count) >= FUNDED_FRACTION] = False
+    funder_rows = pd.DataFrame(funded, columns=funder_cols)
+    funder_rows['Case Study Id'] = df['Case Study Id']
+
+    return df, funder_rows, funder_cols
+
+
+def write_funder_files(funder_rows, funder_cols, data_file_dir):
+    """Write the funders of each study out as the xlsx files read by organise_studies_by_funder.py, one per funder.
+
+    :params: a membership table of funders, a list of the funder cols and the dir to write the files in
+    :return: nothing, saves an xlsx file per funder
+    """
+    for col in funder_cols:
+        # organise_studies_by_funder.py names the funder col after the file
+        funder_name = col[len('funder_'):]
+        funded_ids = funder_rows.loc[funder_rows[col].astype(bool), ['Case Study Id']]
+        funded_ids.to_excel(os.path.join(data_file_dir, funder_name + '.xlsx'), sheet_name='CaseStudies', index=False)
+
+
+def ingest(data_file_dir):
+    """Read and organise the case studies by funder, as organise_studies_by_funder.py does.
+
+    :params: the dir of the xlsx files of each funder
+    :return: a membership table of funders with a Case Study Id col
+    """
+    df = organise_studies_by_funder.read_data(data_file_dir=data_file_dir)
+
+    return organise_studies_by_funder.clean(df).reset_index()
+
+
+class StageTimer(object):
+    """Records how long each stage of a benchmark run takes."""
+
+    def __init__(self):
+        self.timings = {}
+
+    def time(self, stage, func, *args):
+        """Call func with args, recording how long it took under the name of the stage."""
+        start = time.perf_counter()
+        result = func(*args)
+        self.timings[stage] = time.perf_counter() - start
+
+        return result
+
+
+def run_benchmark(scale, search_terms, seed=0):
+    """Time each stage of the pipeline on a synthetic corpus.
+
+    :params: the size of the corpus as a multiple of the real one, a list of search terms and a random seed
+    :return: a dict of the size of the corpus and the seconds each stage took
+    """
+    case_study_count = max(1, int(round(scale * REAL_CASE_STUDY_COUNT)))
+    raw_df, funder_rows, funder_cols = generate_corpus(case_study_count, search_terms, seed)
+    search_places = list(PLACE_WORD_COUNTS)
+    list_of_uoas, uoa_panels = ref_case_studies.load_uoas(UNITS_OF_ASSESSMENT)
+
+    # The stages read and write real files, laid out as the pipeline lays them out,
+    # in a dir that is thrown away afterwards. The columnar cache goes there too
+    work_dir = tempfile.mkdtemp() + os.sep
+    data_file_dir = work_dir + 'studies_by_council' + os.sep
+    os.makedirs(data_file_dir)
+    cache_store = corpus_cache.CACHE_STORE
+    corpus_cache.CACHE_STORE = work_dir + 'cache'
+    try:
+        write_funder_files(funder_rows, funder_cols, data_file_dir)
+
+        timer = StageTimer()
+        df_studies_by_funder = timer.time('ingestion', ingest, data_file_dir)
+        df = timer.time('cleaning', merge_studies_with_funder.clean, raw_df, merge_studies_with_funder.CLEANING_PROCESSES)
+        df = merge_studies_with_funder.associate_new_data(df, df_studies_by_funder)
+        merge_studies_with_funder.export_to_csv(df, work_dir, 'all_ref_case_study_data')
+
+        # Read back the cols the analysis reads, first parsing the csv file and building
+        # the columnar cache, then again from the cache as later runs do
+        funder_cols = ref_case_studies.get_col_list(df, 'funder')
+        cols = ['Case Study Id', 'Unit of Assessment'] + search_places + funder_cols
+        datafilename = work_dir + 'all_ref_case_study_data.csv'
+        timer.time('csv read', ref_case_studies.import_csv_to_df, datafilename, cols)
+        df = timer.time('cached csv read', ref_case_studies.import_csv_to_df, datafilename, cols)
+
+        matcher = TermMatcher(search_terms)
+        hits = timer.time('term matching', ref_case_studies.find_terms_in_places, df, matcher, search_places)
+
+        def summaries():
+            df_compact = ref_case_studies.compact_funder_cols(df, funder_cols)
+            cube = ref_case_studies.count_cube_for(df_compact, hits, funder_cols, list_of_uoas, len(search_terms))
+            return ref_case_studies.summarise_cube(cube, search_terms, search_places, uoa_panels)
+
+        summary_dfs = timer.time('summaries', summaries)
+
+        def export():
+            ids_term_identified = hits.index[hits.any(axis=1)]
+            df_term_identified = df[df['Case Study Id'].isin(ids_term_identified)][ref_case_studies.case_study_export_cols(df)]
+            df_term_identified = df_term_identified.join(ref_case_studies.hits_to_found_in_cols(hits.loc[ids_term_identified]),
+                                                         on='Case Study Id')
+            export_table(df_term_identified, work_dir, ref_case_studies.CASE_STUDY_EXPORT,
+                         ref_case_studies.CASE_STUDY_EXPORT_FORMAT, index=ref_case_studies.EXPORT_FULL_TEXT)
+            export_tables(summary_dfs, work_dir)
+        timer.time('export', export)
+    finally:
+        corpus_cache.CACHE_STORE = cache_store
+        shutil.rmtree(work_dir)
+
+    return {'case studies': case_study_count, 'seconds': timer.timings}
+
+
+def find_regressions(report, baseline):
+    """Compare a benchmark report against a baseline report.
+
+    :params: two reports from main
+    :return: a list of strings describing each stage that is slower than allowed
+    """
+    regressions = []
+    for scale, result in report['results'].items():
+        if scale not in baseline['results']:
+            continue
+        for stage, seconds in result['seconds'].items():
+            baseline_seconds = baseline['results'][scale]['seconds'].get(stage)
+            if baseline_seconds is None or seconds < MIN_REGRESSION_SECONDS:
+                continue
+            if seconds > baseline_seconds * (1 + REGRESSION_TOLERANCE):
+                regressions.append('scale ' + scale + ', ' + stage + ': ' + '%.3fs' % seconds +
+                                   ' against ' + '%.3fs' % baseline_seconds + ' in the baseline')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each stage of the analysis on synthetic corpora.')
+    parser.add_argument('--scales', type=float, nargs='+', default=DEFAULT_SCALES,
+                        help='sizes of the synthetic corpora, as multiples of the real one')
+    parser.add_argument('--baseline', help='a previous report to check for regressions against')
+    parser.add_argument('--report', default=REPORT_FILENAME, help='where to save the report')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    search_terms = ref_case_studies.SoftwareSearchTerms().data
+
+    report = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+              'search terms': len(search_terms), 'seed': args.seed,
+              'regression tolerance': REGRESSION_TOLERANCE, 'results': {}}
+    for scale in args.scales:
+        report['results'][str(scale)] = run_benchmark(scale, search_terms, args.seed)
+        print('scale ' + str(scale) + ': ' + json.dumps(report['results'][str(scale)]['seconds']))
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
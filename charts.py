@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import re
+import json
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+# Figures are drawn straight onto Agg canvases rather than through pyplot, so
+# no figure is ever held by pyplot's global state and there's no need for a display
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import count_cube
+from instrumentation import traced
+
+# Other global variables
+CHART_RESULT_STORE = "outputs/charts/"
+# How many processes draw charts when a batch is drawn from the count cube (None is one per CPU)
+CHART_PROCESSES = None
+# How many charts each process is handed at a time
+CHARTS_PER_TASK = 8
+# Charts drawn from the count cube only show the largest counts
+MAX_BARS = 20
+# The size of a single chart, and of each panel of a grid, in inches
+CHART_SIZE = (6.4, 4.8)
+PANEL_SIZE = (4, 3)
+
+
+def chart_spec(df, y_col, title, x_axis_title='', y_axis_title=''):
+    """Describe a bar chart of one col of a summary dataframe.
+
+    A chart spec is a dict of plain lists and strings, so it can be handed to
+    another process or saved as JSON
+    :params: a dataframe, the col to plot, and the title and axis titles of the chart
+    :return: a dict with the labels and values of the bars and the titles
+    """
+    return {'labels': [str(label) for label in df.index], 'values': [float(value) for value in df[y_col]],
+            'title': title, 'x_axis_title': x_axis_title, 'y_axis_title': y_axis_title}
+
+
+def grid_spec(panels, title, cols=4):
+    """Describe a grid of small bar charts saved as one image.
+
+    :params: a list of chart specs from chart_spec, the title of the grid and the number of charts in each row
+    :return: a dict with the panels, title and number of cols
+    """
+    return {'panels': panels, 'title': title, 'cols': cols}
+
+
+def draw_bar(ax, spec, label_values=True):
+    """Draw a functional, rather than a pretty, bar chart on a set of axes.
+
+    Pretty charts can be made in the "graphing for presentations code" repo in Github
+    :params: a matplotlib Axes, a chart spec and whether to write the value above each bar
+    :return: nothing
+    """
+    positions = np.arange(len(spec['values']))
+    ax.bar(positions, spec['values'], align='center')
+    ax.set_xticks(positions)
+    ax.set_xticklabels(spec['labels'], rotation=90)
+    ax.set_xlim(-0.5, len(positions) - 0.5)
+    if label_values:
+        for i, value in enumerate(spec['values']):
+            ax.text(i-0.3, value+0.2, int(value))
+
+    ax.tick_params(top=False, bottom=False, left=False, right=False)
+
+    ax.set_title(spec['title'])
+    ax.set_xlabel(spec['x_axis_title'])
+    ax.set_ylabel(spec['y_axis_title'])
+
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+
+
+def render_chart(spec, chart_store=CHART_RESULT_STORE):
+    """Draw a chart or grid of charts and save it as a PNG file named after its title.
+
+    The figure is cleared once it is saved, so drawing any number of charts
+    one after another doesn't hold on to any of them
+    :params: a chart spec from chart_spec or grid_spec, and the dir to save the chart in
+    :return: the filename of the chart
+    """
+    if 'panels' in spec:
+        cols = min(spec['cols'], len(spec['panels']))
+        rows = int(math.ceil(len(spec['panels']) / float(cols)))
+        fig = Figure(figsize=(PANEL_SIZE[0] * cols, PANEL_SIZE[1] * rows))
+        FigureCanvasAgg(fig)
+        for i, panel in enumerate(spec['panels']):
+            draw_bar(fig.add_subplot(rows, cols, i + 1), panel, label_values=False)
+        fig.suptitle(spec['title'])
+        # Leave room at the top for the title of the grid
+        fig.tight_layout(rect=(0, 0, 1, 0.97))
+    else:
+        fig = Figure(figsize=CHART_SIZE)
+        FigureCanvasAgg(fig)
+        draw_bar(fig.add_subplot(1, 1, 1), spec)
+        # This provides more space around the chart to make it prettier
+        fig.tight_layout()
+
+    filename = chart_store + re.sub(r'[^\w.-]', '_', spec['title']) + '.png'
+    fig.savefig(filename, format='png', dpi=150)
+    fig.clf()
+
+    return filename
+
+
+def render_chart_list(specs, chart_store):
+    """Draw a list of charts one after another, for a worker process."""
+    return [render_chart(spec, chart_store) for spec in specs]
+
+
+@traced
+def render_chart_batch(specs, chart_store=CHART_RESULT_STORE, processes=1):
+    """Draw a batch of charts, spread across a pool of processes.
+
+    :params: a list of chart specs from chart_spec or grid_spec, the dir to save the charts in,
+             and the number of processes to use (None is one per CPU, 1 draws them in this process)
+    :return: a list of the filenames of the charts, in the order of the specs
+    """
+    if processes == 1 or len(specs) <= 1:
+        return render_chart_list(specs, chart_store)
+
+    # Hand out the charts a few at a time, so the cost of sending them to the processes is spread out
+    tasks = [specs[start:start + CHARTS_PER_TASK] for start in range(0, len(specs), CHARTS_PER_TASK)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        filenames = executor.map(render_chart_list, tasks, [chart_store] * len(tasks))
+
+    return [filename for task_filenames in filenames for filename in task_filenames]
+
+
+def largest(counts, title, x_axis_title, y_axis_title):
+    """Describe a bar chart of the largest of a series of counts.
+
+    :params: a series of counts, and the title and axis titles of the chart
+    :return: a chart spec
+    """
+    counts = counts[counts > 0].sort_values(ascending=False)[:MAX_BARS]
+
+    return chart_spec(counts.to_frame('count'), 'count', title, x_axis_title, y_axis_title)
+
+
+def cube_chart_specs(cube, grid_cols=4):
+    """Describe the charts of each funder, UoA and search term, from the count cube.
+
+    There is a chart of the search terms found in the case studies of each
+    funder and of each UoA, and a chart of the UoAs of the case studies each
+    search term was found in. Each set of charts is also drawn as a grid
+    :params: a CountCube saved by ref_case_studies.py and the number of charts in each row of a grid
+    :return: a list of chart specs
+    """
+    terms = [term for term in cube.coords['term'] if not count_cube.is_margin(term)]
+    funders = [funder for funder in cube.coords['funder'] if not count_cube.is_margin(funder)]
+    uoas = [uoa for uoa in cube.coords['uoa'] if not count_cube.is_margin(uoa)]
+
+    funder_specs = [largest(cube.select(term=terms, place=count_cube.ANYWHERE, funder=funder, uoa=count_cube.ALL),
+                            'Search terms in case studies funded by ' + funder.replace('funder_', '').replace('_', ' '),
+                            '', 'case studies')
+                    for funder in funders]
+    uoa_specs = [largest(cube.select(term=terms, place=count_cube.ANYWHERE, funder=count_cube.ALL, uoa=uoa),
+                         'Search terms in ' + uoa + ' case studies', '', 'case studies')
+                 for uoa in uoas]
+    term_specs = [largest(cube.select(term=term, place=count_cube.ANYWHERE, funder=count_cube.ALL, uoa=uoas),
+                          'Units of assessment of case studies mentioning ' + term, '', 'case studies')
+                  for term in terms]
+
+    specs = funder_specs + uoa_specs + term_specs
+    for title, panels in [('Search terms by funder', funder_specs), ('Search terms by unit of assessment', uoa_specs),
+                          ('Units of assessment by search term', term_specs)]:
+        panels = [panel for panel in panels if panel['values']]
+        if panels:
+            specs.append(grid_spec(panels, title, grid_cols))
+
+    return specs
+
+
+@traced
+def render_charts(chart_jobs, chart_store=CHART_RESULT_STORE, processes=1):
+    """Draw a chart for each of a list of summaries saved as CSV files.
+
+    :params: a list of chart jobs, each a dict with the 'csv' file of a summary and the 'y_col',
+             'title', 'x_axis_title' and 'y_axis_title' to pass to chart_spec, the dir to save the
+             charts in and the number of processes to draw them with
+    :return: nothing, saves PNG charts
+    """
+    specs = [chart_spec(pd.read_csv(job['csv'], index_col=0), job['y_col'], job['title'], job['x_axis_title'], job['y_axis_title'])
+             for job in chart_jobs]
+    render_chart_batch(specs, chart_store, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Draw charts of the summaries, or of each funder, UoA and search term.')
+    parser.add_argument('chart_store', nargs='?', default=CHART_RESULT_STORE, help='the dir to save the charts in')
+    # Passed by ref_case_studies.render_charts_in_background
+    parser.add_argument('chart_jobs', nargs='?', help='chart jobs as JSON, as described in render_charts')
+    parser.add_argument('--cube', action='store_true',
+                        help='draw charts of each funder, UoA and search term from ' + count_cube.CUBE_FILENAME)
+    parser.add_argument('--processes', type=int, default=CHART_PROCESSES, help='how many processes to draw charts with')
+    args = parser.parse_args()
+
+    if args.chart_jobs:
+        render_charts(json.loads(args.chart_jobs), args.chart_store, args.processes or 1)
+    if args.cube:
+        render_chart_batch(cube_chart_specs(count_cube.load_count_cube()), args.chart_store, args.processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import argparse
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy import sparse
+except ImportError:
+    # Without scipy the incidence matrices are held as dense boolean arrays and
+    # multiplied a block of rows at a time, which gives the same counts
+    sparse = None
+
+from corpus_loader import load_corpus
+from instrumentation import traced
+
+# Other global variables
+RESULT_STORE = "outputs/"
+# The group the counts across every case study are given in the ranked pair list
+ALL_STUDIES = '(all studies)'
+# How many rows of a dense incidence matrix are multiplied at a time when scipy isn't available
+DENSE_BLOCK_SIZE = 10000
+
+
+def incidence_matrix(found):
+    """Make an incidence matrix from a boolean array.
+
+    :params: a boolean array with a row per case study (or per case study and place) and a col per term
+    :return: a sparse CSR matrix with a 1 where the term was found if scipy is available, otherwise the boolean array
+    """
+    if sparse is None:
+        return found
+
+    rows, cols = np.nonzero(found)
+
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=found.shape)
+
+
+def cooccurrence_counts(incidence, rows=None):
+    """Count how often each pair of terms is found together, as the incidence matrix times its transpose.
+
+    :params: an incidence matrix from incidence_matrix, and optionally the positions of the rows to count
+    :return: a square int array with the count for each pair of terms, and the count for each term on the diagonal
+    """
+    if rows is not None:
+        incidence = incidence[rows]
+
+    if sparse is not None:
+        return incidence.T.dot(incidence).toarray().astype(np.int64)
+
+    # float32 products are exact for counts up to 2 ** 24
+    counts = np.zeros((incidence.shape[1], incidence.shape[1]), dtype=np.int64)
+    for start in range(0, len(incidence), DENSE_BLOCK_SIZE):
+        block = incidence[start:start + DENSE_BLOCK_SIZE].astype(np.float32)
+        counts += np.rint(block.T.dot(block)).astype(np.int64)
+
+    return counts
+
+
+class CooccurrenceCounter(object):
+    """Counts how often pairs of search terms are found in the same case study, and in the same place.
+
+    The incidence matrices are built once from the hit array: one with a row
+    per case study, and one with a row per case study and place. Counts for a
+    group of case studies, such as those of one funder, are made from the rows
+    of those studies. A third has a row per case study and a col per (term, place)
+    pair, to count how often a term in one place is found with a term in another.
+    """
+
+    def __init__(self, hit_array):
+        self.place_count = hit_array.shape[2]
+        self.study_incidence = incidence_matrix(hit_array.any(axis=2))
+        # Lay the places of each study out as consecutive rows
+        self.place_incidence = incidence_matrix(hit_array.transpose(0, 2, 1).reshape(-1, hit_array.shape[1]))
+        # Lay the (term, place) pairs out as in the hit matrix, the places of each term next to each other
+        self.term_place_incidence = incidence_matrix(hit_array.reshape(hit_array.shape[0], -1))
+
+    def count(self, studies=None):
+        """Count the co-occurrences of the terms.
+
+        :params: optionally a boolean array picking out the case studies to count
+        :return: a tuple of square int arrays, counting the studies each pair of terms was
+                 found in, and the (study, place) pairs each pair of terms was found in
+        """
+        if studies is None:
+            return cooccurrence_counts(self.study_incidence), cooccurrence_counts(self.place_incidence)
+
+        return (cooccurrence_counts(self.study_incidence, np.flatnonzero(studies)),
+                cooccurrence_counts(self.place_incidence, np.flatnonzero(np.repeat(studies, self.place_count))))
+
+    def count_term_places(self):
+        """Count the co-occurrences of the (term, place) pairs across every case study.
+
+        :return: a square int array counting the studies each two (term, place) pairs were both found in,
+                 in the order of the cols of the hit matrix
+        """
+        return cooccurrence_counts(self.term_place_incidence)
+
+
+def ranked_pairs(terms, study_counts, place_counts, group=ALL_STUDIES, min_studies=1):
+    """List the pairs of terms found together, most often first.
+
+    :params: a list of the terms, the counts from CooccurrenceCounter.count, the name of the group of
+             case studies that was counted and the fewest studies a pair must be found in to be listed
+    :return: a dataframe with a row for each pair, giving the number of studies each term was found in,
+             the number both were found in, the number of places both were found in and the Jaccard
+             index of the studies of the two terms
+    """
+    first, second = np.triu_indices(len(terms), 1)
+    together = study_counts[first, second]
+    keep = together >= max(min_studies, 1)
+    first, second, together = first[keep], second[keep], together[keep]
+
+    terms = np.asarray(terms, dtype=object)
+    studies_with_first = np.diag(study_counts)[first]
+    studies_with_second = np.diag(study_counts)[second]
+
+    pairs = pd.DataFrame({'group': group, 'term a': terms[first], 'term b': terms[second],
+                          'studies with term a': studies_with_first, 'studies with term b': studies_with_second,
+                          'studies with both': together, 'places with both': place_counts[first, second],
+                          'jaccard index': np.round(together / (studies_with_first + studies_with_second - together).astype(float), 3)},
+                         columns=['group', 'term a', 'term b', 'studies with term a', 'studies with term b',
+                                  'studies with both', 'places with both', 'jaccard index'])
+    pairs.sort_values(['studies with both', 'places with both', 'term a', 'term b'],
+                      ascending=[False, False, True, True], inplace=True)
+
+    return pairs.reset_index(drop=True)
+
+
+@traced
+def cooccurrence_by_group(corpus, by=None, min_studies=1):
+    """Count the co-occurrences of the terms across every case study, and optionally in each group of them.
+
+    :params: a LoadedCorpus, None, 'funder' or 'uoa' to say how to group the case studies,
+             and the fewest studies a pair must be found in to be listed
+    :return: a tuple of a dataframe of the number of studies each pair of terms was found in across
+             every case study, a dataframe of the number of studies each two (term, place) pairs
+             were both found in, and a ranked pair list with the pairs of each group
+    """
+    counter = CooccurrenceCounter(corpus.hit_array)
+
+    study_counts, place_counts = counter.count()
+    matrix = pd.DataFrame(study_counts, index=corpus.terms, columns=corpus.terms)
+    term_places = pd.MultiIndex.from_product([corpus.terms, corpus.places], names=['term', 'place'])
+    place_matrix = pd.DataFrame(counter.count_term_places(), index=term_places, columns=term_places)
+    pair_lists = [ranked_pairs(corpus.terms, study_counts, place_counts, ALL_STUDIES, min_studies)]
+
+    groups = []
+    if by == 'funder':
+        groups = [(col, corpus.funders[:, i]) for i, col in enumerate(corpus.funder_cols)]
+    elif by == 'uoa':
+        groups = [(uoa, corpus.uoa_codes == i) for i, uoa in enumerate(corpus.list_of_uoas)]
+
+    for group, studies in groups:
+        if studies.any():
+            study_counts, place_counts = counter.count(studies)
+            pair_lists.append(ranked_pairs(corpus.terms, study_counts, place_counts, group, min_studies))
+
+    return matrix, place_matrix, pd.concat(pair_lists, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count how often pairs of search terms are found in the same case study.')
+    parser.add_argument('--by', choices=['funder', 'uoa'], help='also count the pairs in the case studies of each funder or UoA')
+    parser.add_argument('--min-studies', type=int, default=1, help='leave out pairs found together in fewer studies than this')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    matrix, place_matrix, pairs = cooccurrence_by_group(corpus, args.by, args.min_studies)
+
+    matrix.to_csv(RESULT_STORE + 'term_cooccurrence_matrix.csv')
+    place_matrix.to_csv(RESULT_STORE + 'term_place_cooccurrence_matrix.csv')
+    pairs.to_csv(RESULT_STORE + 'term_cooccurrence_pairs.csv', index=False)
+
+
+if __name__ == '__main__':
+    main()
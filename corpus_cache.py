@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import pickle
+import hashlib
+import tempfile
+import pandas as pd
+
+# Other global variables
+CACHE_STORE = "input/generated/cache/"
+# Copies that are still being written have names starting with this
+BUILD_PREFIX = '.build-'
+
+
+def file_fingerprint(filename):
+    """Identify the current version of a file without reading it.
+
+    :params: a filename
+    :return: a (size, modification time) tuple
+    """
+    stat = os.stat(filename)
+
+    return stat.st_size, stat.st_mtime
+
+
+def cache_dir_for(filename):
+    """Find the directory where the columnar copies of a csv file are kept.
+
+    The directory is named after the full path of the csv file, so csv files
+    with the same name in different directories don't share a cache
+    :params: a csv filename
+    :return: a directory name
+    """
+    path = os.path.realpath(filename)
+    path_hash = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+
+    return os.path.join(CACHE_STORE, os.path.splitext(os.path.basename(filename))[0] + '-' + path_hash)
+
+
+def version_dir_for(cache_dir, source_fingerprint):
+    """Find the directory of the columnar copy of one version of a csv file.
+
+    :params: the cache directory of a csv file and the fingerprint of the version
+    :return: a directory name
+    """
+    return os.path.join(cache_dir, str(source_fingerprint[0]) + '-' + repr(source_fingerprint[1]))
+
+
+def build_cache(filename, cache_dir):
+    """Convert a csv file into a columnar cache.
+
+    Each column is pickled to its own file, so that a stage can load the
+    columns it needs without parsing or holding any of the others. A manifest
+    records the column order and the fingerprint of the csv file. Each version
+    of the csv file gets its own directory, which is written under a temporary
+    name and renamed into place once it is complete, so a process reading the
+    cache never sees a half-written copy, even while another process builds it.
+    The copies of older versions are then removed
+    :params: a csv filename and the directory to store the cache in
+    :return: the whole csv file as a df
+    """
+    # Fingerprint the file before reading it, so a change made while it is read makes the copy out of date
+    source_fingerprint = file_fingerprint(filename)
+    df = pd.read_csv(filename)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=cache_dir)
+
+    for i, col in enumerate(df.columns):
+        with open(os.path.join(build_dir, str(i) + '.pickle'), 'wb') as f:
+            pickle.dump(df[col].values, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    manifest = {'source_fingerprint': source_fingerprint, 'columns': list(df.columns)}
+    with open(os.path.join(build_dir, 'manifest.pickle'), 'wb') as f:
+        pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    version_dir = version_dir_for(cache_dir, source_fingerprint)
+    try:
+        os.replace(build_dir, version_dir)
+    except OSError:
+        # Another process has already put a copy of this version in place
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    for name in os.listdir(cache_dir):
+        old_dir = os.path.join(cache_dir, name)
+        if old_dir != version_dir and not name.startswith(BUILD_PREFIX):
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    return df
+
+
+def load_manifest(filename, cache_dir):
+    """Load the manifest of the columnar copy of the current version of a csv file.
+
+    :params: a csv filename and the directory its cache is stored in
+    :return: a tuple of a manifest dict and the directory of the copy, or (None, None)
+             if the current version of the csv file hasn't been copied
+    """
+    version_dir = version_dir_for(cache_dir, file_fingerprint(filename))
+    manifest_file = os.path.join(version_dir, 'manifest.pickle')
+    if not os.path.exists(manifest_file):
+        return None, None
+
+    with open(manifest_file, 'rb') as f:
+        return pickle.load(f), version_dir
+
+
+def read_cached_csv(filename, columns=None):
+    """Imports a csv file into a Pandas dataframe through a columnar cache.
+
+    The first read of a csv file parses it and builds the cache, later reads
+    only unpickle the columns asked for. The cache is rebuilt whenever the csv
+    file changes
+    :params: a csv filename and optionally a list of the columns to load
+    :return: a df with the columns asked for (or all columns) in the order they appear in the csv file
+    """
+    cache_dir = cache_dir_for(filename)
+    manifest, version_dir = load_manifest(filename, cache_dir)
+
+    if manifest is None:
+        df = build_cache(filename, cache_dir)
+        if columns is None:
+            return df
+        manifest = {'columns': list(df.columns)}
+    else:
+        df = None
+
+    if columns is not None:
+        missing = [col for col in columns if col not in manifest['columns']]
+        if missing:
+            raise KeyError('Columns not found in ' + filename + ': ' + ', '.join(missing))
+        if df is not None:
+            return df[[col for col in df.columns if col in columns]]
+
+    data = {}
+    col_order = []
+    for i, col in enumerate(manifest['columns']):
+        if columns is None or col in columns:
+            with open(os.path.join(version_dir, str(i) + '.pickle'), 'rb') as f:
+                data[col] = pickle.load(f)
+            col_order.append(col)
+
+    return pd.DataFrame(data, columns=col_order)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import re
+import pickle
+from array import array
+import numpy as np
+
+from corpus_cache import file_fingerprint, read_cached_csv
+
+# Other global variables
+DATAFILENAME = "input/generated/all_ref_case_study_data.csv"
+INDEX_FILENAME = "input/generated/corpus_index.pickle"
+# The layout of the saved index. An index saved in an older layout is treated as missing
+INDEX_VERSION = 2
+
+# The parts of the case study that are indexed. These are the same parts
+# that ref_case_studies.py searches in
+INDEXED_PLACES = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+
+# A token is either a run of word characters or a single punctuation character,
+# so that 'open-source' and 'open source' are told apart when looking up phrases
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+
+def tokenize(text):
+    """Split a piece of text into tokens.
+
+    :params: a string
+    :return: a list of (token, character offset) tuples in order of offset
+    """
+    if not isinstance(text, str):
+        return []
+
+    return [(match.group(), match.start()) for match in TOKEN_PATTERN.finditer(text)]
+
+
+class CorpusIndex(object):
+    """An inverted index from token to where it appears in the case studies.
+
+    Each part of each case study that was indexed is a location, numbered in
+    the order it was indexed. The postings of every token are held in three
+    int32 arrays, laid out as in a CSR sparse matrix: the postings of a token
+    are one slice of the arrays, running from its start to the start of the
+    next token, and give the location, token position and character offset
+    of each occurrence, sorted by location and then position. A phrase can
+    then be looked up with a few vectorised searches of the arrays, and the
+    index is pickled as a handful of arrays rather than millions of tuples.
+    """
+
+    def __init__(self, places, location_ids, location_places, token_numbers, starts, locations, positions, offsets,
+                 source_fingerprint=None):
+        self.version = INDEX_VERSION
+        self.places = list(places)
+        self.source_fingerprint = source_fingerprint
+        # The Case Study Id and the position in places of each location
+        self.location_ids = location_ids
+        self.location_places = location_places
+        # The number of each token, and where its postings start (with the end of the postings at the end)
+        self.token_numbers = token_numbers
+        self.starts = starts
+        self.locations = locations
+        self.positions = positions
+        self.offsets = offsets
+
+    def postings_for(self, token):
+        """Find where a token appears.
+
+        :params: a token
+        :return: arrays of the location, token position and character offset of each occurrence,
+                 sorted by location and then position, which are empty for a token not in the index
+        """
+        number = self.token_numbers.get(token)
+        if number is None:
+            return self.locations[:0], self.positions[:0], self.offsets[:0]
+        start, end = self.starts[number], self.starts[number + 1]
+
+        return self.locations[start:end], self.positions[start:end], self.offsets[start:end]
+
+    def can_look_up(self, term):
+        """Check whether a term can be answered from the index alone.
+
+        Terms that start or end with punctuation (e.g. '.net') depend on the
+        characters either side of them to find a word boundary, so they still
+        have to be found by scanning the text
+        :params: a search term
+        :return: True if find_term gives the same result as a regex scan
+        """
+        return re.match(r'\w', term[:1]) is not None and re.match(r'\w', term[-1:]) is not None
+
+    def find_term_offsets(self, term):
+        """Find every occurrence of a search term.
+
+        A term made of several tokens is found where its tokens are next to
+        each other and spaced out in the same way as in the term itself
+        :params: a search term
+        :return: a dict keyed on (Case Study Id, place) of lists of character offsets
+        """
+        tokens = tokenize(term.lower())
+        if not tokens:
+            return {}
+
+        first_token, first_offset = tokens[0]
+        locations, positions, offsets = self.postings_for(first_token)
+        found = np.ones(len(locations), dtype=bool)
+        for i, (token, term_offset) in enumerate(tokens[1:], 1):
+            # The rest of the phrase must be at the following token positions, the same
+            # number of characters along as in the term. The postings of a token are
+            # sorted by location and position, so they're searched for with one searchsorted
+            later_locations, later_positions, later_offsets = self.postings_for(token)
+            if not len(later_locations):
+                return {}
+            later_keys = (later_locations.astype(np.int64) << 32) | later_positions
+            wanted_keys = (locations.astype(np.int64) << 32) | (positions + i)
+            at = np.minimum(np.searchsorted(later_keys, wanted_keys), len(later_keys) - 1)
+            found &= (later_keys[at] == wanted_keys) & (later_offsets[at] == offsets + (term_offset - first_offset))
+        locations = locations[found]
+        offsets = offsets[found]
+
+        # Split the offsets up by location, which they are already sorted by
+        found_locations, first_rows = np.unique(locations, return_index=True)
+        study_ids = self.location_ids[found_locations].tolist()
+        places = [self.places[place] for place in self.location_places[found_locations]]
+
+        return {(study_id, place): location_offsets.tolist()
+                for study_id, place, location_offsets in zip(study_ids, places, np.split(offsets, first_rows[1:]))}
+
+    def find_term(self, term):
+        """Find which parts of which case studies contain a search term.
+
+        :params: a search term
+        :return: a set of (Case Study Id, place) tuples
+        """
+        return set(self.find_term_offsets(term))
+
+
+def build_index(dataframe, places, source_fingerprint=None):
+    """Build an inverted index over some parts of the case studies.
+
+    Every token is first recorded in compact arrays in the order it was read,
+    then the arrays are sorted by token in one stable sort, which keeps the
+    postings of each token in order of location and position
+    :params: a dataframe of case studies, a list of the columns to index and
+             optionally the fingerprint of the file the dataframe came from
+    :return: a CorpusIndex
+    """
+    token_numbers = {}
+    location_ids = []
+    location_places = []
+    token_col, location_col, position_col, offset_col = array('i'), array('i'), array('i'), array('i')
+    for place_number, place in enumerate(places):
+        for study_id, text in zip(dataframe['Case Study Id'], dataframe[place]):
+            tokens = tokenize(text)
+            if not tokens:
+                continue
+            location = len(location_ids)
+            location_ids.append(study_id)
+            location_places.append(place_number)
+            token_col.extend(token_numbers.setdefault(token, len(token_numbers)) for token, _ in tokens)
+            location_col.extend([location] * len(tokens))
+            position_col.extend(range(len(tokens)))
+            offset_col.extend(offset for _, offset in tokens)
+
+    token_col = np.frombuffer(token_col, dtype=np.int32)
+    order = np.argsort(token_col, kind='mergesort')
+    starts = np.zeros(len(token_numbers) + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(np.bincount(token_col, minlength=len(token_numbers)))
+
+    return CorpusIndex(places, np.array(location_ids), np.array(location_places, dtype=np.int32), token_numbers, starts,
+                       np.frombuffer(location_col, dtype=np.int32)[order], np.frombuffer(position_col, dtype=np.int32)[order],
+                       np.frombuffer(offset_col, dtype=np.int32)[order], source_fingerprint)
+
+
+def save_index(index, filename):
+    """Pickle an index to disk.
+
+    :params: a CorpusIndex and a filename
+    :return: nothing, saves a pickle
+    """
+    with open(filename, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_index(filename, source_filename):
+    """Load an index from disk if it is still up to date.
+
+    :params: the filename of a saved index and the csv file it was built from
+    :return: a CorpusIndex, or None if there is no index, it was saved in an older layout
+             or the csv file has changed since it was built
+    """
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, 'rb') as f:
+        index = pickle.load(f)
+
+    if getattr(index, 'version', None) != INDEX_VERSION:
+        return None
+    if index.source_fingerprint != file_fingerprint(source_filename):
+        return None
+
+    return index
+
+
+def main():
+    # Import the parts of the case study data written by merge_studies_with_funder.py
+    # that are indexed
+    df = read_cached_csv(DATAFILENAME, ['Case Study Id'] + INDEXED_PLACES)
+
+    # Index the parts of the case studies that are searched
+    index = build_index(df, INDEXED_PLACES, file_fingerprint(DATAFILENAME))
+
+    # Save the index alongside the data it was built from
+    save_index(index, INDEX_FILENAME)
+
+
+if __name__ == '__main__':
+    # Run through the imported module, so that the pickled index refers to
+    # corpus_index.CorpusIndex rather than __main__.CorpusIndex
+    import corpus_index
+    corpus_index.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import numpy as np
+
+import ref_case_studies
+from ref_case_studies import SoftwareSearchTerms
+from term_matching import TermMatcher
+from corpus_cache import file_fingerprint
+from hit_cache import corpus_hash_for, load_hit_cache, save_hit_cache
+from text_store import load_text_store
+from sentence_finder import CONTEXT_WINDOW
+from instrumentation import traced
+
+# Other global variables
+DATAFILENAME = "input/generated/all_ref_case_study_data.csv"
+STUDIES_BY_FUNDER = "input/generated/list_of_studies_by_council.csv"
+UNITS_OF_ASSESSMENT = "input/raw/units_of_assessment.csv"
+# How many snippets a snippet query returns unless it asks for a different number
+SNIPPET_LIMIT = 20
+
+SEARCH_PLACES = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+
+
+class QueryError(Exception):
+    """A query that can't be answered, e.g. because it names an unknown term or funder."""
+
+
+class LoadedCorpus(object):
+    """The case studies and where each search term was found in them, held in memory to be queried.
+
+    Everything a query filters on is kept as an array with an entry per case
+    study: the hit matrix as a [study, term, place] boolean array, the funder
+    cols as booleans and the Units of Assessment as categorical codes. A query
+    is then a few vectorised operations on those arrays.
+    """
+
+    def __init__(self, fingerprint, df, hits, funder_cols, list_of_uoas, text_store=None):
+        self.fingerprint = fingerprint
+        self.df = df
+        self.text_store = text_store
+        self.terms, self.places, self.hit_array = ref_case_studies.hits_to_array(hits)
+        self.matcher = TermMatcher(self.terms)
+        self.funder_cols = funder_cols
+        self.funders = df[funder_cols].values
+        self.list_of_uoas = list_of_uoas
+        self.uoa_codes = ref_case_studies.get_uoa_ids(df['Unit of Assessment'], list_of_uoas).codes
+
+    def describe(self):
+        """Describe what has been loaded.
+
+        :return: a dict of the case study count, search terms, places, funders and Units of Assessment
+        """
+        return {'case studies': len(self.df), 'terms': self.terms, 'places': self.places,
+                'funders': [col.replace('funder_', '') for col in self.funder_cols], 'uoas': self.list_of_uoas}
+
+    def look_up(self, values, known, name, prefix=''):
+        """Find the positions of queried values in a list of known values.
+
+        :params: a list of queried values, the list of known values, what the values are
+                 (for the error message) and a prefix the known values may have that the queried ones can leave off
+        :return: a list of positions in the known list
+        """
+        positions = []
+        for value in values:
+            value = ' '.join(value.lower().split())
+            if value in known:
+                positions.append(known.index(value))
+            elif prefix + value.replace(' ', '_') in known:
+                positions.append(known.index(prefix + value.replace(' ', '_')))
+            else:
+                raise QueryError('Unknown ' + name + ': ' + value)
+
+        return positions
+
+    def select(self, query):
+        """Find the case studies matching a query.
+
+        A query can name any number of terms, places, funders and UoAs. A case
+        study matches if any of the terms was found in any of the places, and it
+        is linked to any of the funders and is in any of the UoAs. Leaving out
+        terms, places, funders or UoAs doesn't filter on them
+        :params: a dict of query parameter to list of values, as from parse_qs
+        :return: a tuple of a boolean array with an entry per case study, and the positions of the terms and places
+        """
+        term_positions = self.look_up(query.get('term', []), self.terms, 'term') or list(range(len(self.terms)))
+        places = [place for place in query.get('place', []) if place.lower() != 'anywhere']
+        place_positions = self.look_up(places, [place.lower() for place in self.places], 'place') or list(range(len(self.places)))
+
+        if query.get('term') or places:
+            selected = self.hit_array[:, term_positions][:, :, place_positions].any(axis=(1, 2))
+        else:
+            selected = np.ones(len(self.df), dtype=bool)
+
+        funder_positions = self.look_up(query.get('funder', []), self.funder_cols, 'funder', 'funder_')
+        if funder_positions:
+            selected &= self.funders[:, funder_positions].any(axis=1)
+
+        uoa_positions = self.look_up(query.get('uoa', []), self.list_of_uoas, 'unit of assessment')
+        if uoa_positions:
+            # Case studies in no known UoA have a code of -1, which picks out the extra False at the end
+            wanted_uoas = np.zeros(len(self.list_of_uoas) + 1, dtype=bool)
+            wanted_uoas[uoa_positions] = True
+            selected &= wanted_uoas[self.uoa_codes]
+
+        return selected, term_positions, place_positions
+
+    def count(self, query):
+        """Count the case studies matching a query.
+
+        :params: a dict of query parameter to list of values
+        :return: a dict of the count, the count of all case studies and the Case Study Ids matched
+        """
+        selected, _, _ = self.select(query)
+        ids = self.df['Case Study Id'].values[selected]
+
+        return {'count': int(selected.sum()), 'all studies count': len(self.df), 'case study ids': ids.tolist()}
+
+    def snippets(self, query):
+        """Find the text around each occurrence of the queried terms in the case studies matching a query.
+
+        :params: a dict of query parameter to list of values, which may also give a limit on the number of snippets
+        :return: a dict of the number of case studies matched and a list of snippets, each
+                 giving the Case Study Id, place, term, offset and text around the term
+        """
+        selected, term_positions, place_positions = self.select(query)
+        try:
+            limit = int(query.get('limit', [SNIPPET_LIMIT])[0])
+        except ValueError:
+            raise QueryError('The limit must be a whole number')
+        if limit < 0:
+            raise QueryError('The limit must not be negative')
+        if limit == 0:
+            return {'count': int(selected.sum()), 'snippets': []}
+
+        wanted_terms = set(self.terms[i] for i in term_positions)
+        snippets = []
+        for row in np.flatnonzero(selected):
+            study_id = self.df['Case Study Id'].values[row]
+            for i in place_positions:
+                # Only scan the places where one of the terms was found
+                if not self.hit_array[row, term_positions, i].any():
+                    continue
+                if self.text_store is None:
+                    text = self.df[self.places[i]].values[row]
+                else:
+                    text = self.text_store.get_text(self.text_store.rows_for([study_id])[0], self.places[i])
+                for offset, term in self.matcher.iter_matches(text):
+                    if term not in wanted_terms:
+                        continue
+                    if len(snippets) == limit:
+                        return {'count': int(selected.sum()), 'snippets': snippets}
+                    snippets.append({'case study id': int(study_id), 'place': self.places[i], 'term': term, 'offset': offset,
+                                     'snippet': text[max(offset - CONTEXT_WINDOW, 0):offset + len(term) + CONTEXT_WINDOW]})
+
+        return {'count': int(selected.sum()), 'snippets': snippets}
+
+
+@traced
+def load_corpus(filename=DATAFILENAME):
+    """Load the case studies and find where each search term is in them.
+
+    The terms are found as in ref_case_studies.py, so the inverted index and
+    hit cache are used when they are up to date
+    :params: a csv file of case studies
+    :return: a LoadedCorpus
+    """
+    # Fingerprint the file before reading it, so a change made while it is read is picked up by the next check
+    fingerprint = file_fingerprint(filename)
+
+    # The funders and UoAs are read as ref_case_studies.py reads them, so queries match the summaries
+    list_of_funders = ref_case_studies.load_funders(STUDIES_BY_FUNDER)
+    list_of_uoas, _ = ref_case_studies.load_uoas(UNITS_OF_ASSESSMENT)
+
+    # The text of the case studies is read from the text store when it is up to
+    # date, so it isn't held in memory between queries
+    text_store = load_text_store(filename)
+    if text_store is not None and not text_store.has_places(SEARCH_PLACES):
+        text_store = None
+    text_cols = SEARCH_PLACES if text_store is None else []
+    df = ref_case_studies.import_csv_to_df(filename, ['Case Study Id', 'Unit of Assessment'] + text_cols + list_of_funders)
+    funder_cols = ref_case_studies.get_col_list(df, 'funder')
+    df = ref_case_studies.compact_funder_cols(df, funder_cols)
+
+    matcher = TermMatcher(SoftwareSearchTerms().data)
+    hit_cache = load_hit_cache(corpus_hash_for(filename), df['Case Study Id'].values)
+    index = ref_case_studies.load_index_for_missing_terms(hit_cache, matcher, SEARCH_PLACES, filename)
+    hits = ref_case_studies.find_terms_in_places_cached(df, hit_cache, matcher, SEARCH_PLACES, index, text_store)
+    save_hit_cache(hit_cache)
+
+    return LoadedCorpus(fingerprint, df, hits, funder_cols, list_of_uoas, text_store)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+
+# Other global variables
+CUBE_FILENAME = "outputs/count_cube.pickle"
+RESULT_STORE = "outputs/"
+
+# Members of the term axis that aren't search terms: the studies with any term
+# found, the studies with exactly N (term, place) matches in total, and every study
+ANY_TERM = '(any term)'
+MATCHING_WORDS = '(matching {} words)'
+ALL_STUDIES = '(all studies)'
+# The member of the place axis for a term found in any place
+ANYWHERE = 'anywhere'
+# The member of the funder and UoA axes that doesn't filter on them
+ALL = '(all)'
+
+DIMS = ['term', 'place', 'funder', 'uoa']
+
+# The col of a sample made by reduce_df_for_test.py giving how many case studies each sampled case study stands for,
+# which the cube counts case studies by
+SAMPLING_WEIGHT = 'sampling weight'
+
+# How many case studies are added to the cube at a time, which bounds the memory used to build it
+CUBE_BLOCK_SIZE = 2000
+
+
+class CountCube(object):
+    """Counts of case studies by term, place, funder and Unit of Assessment.
+
+    counts[term, place, funder, uoa] is the number of case studies in which the
+    term was found in the place, that are linked to the funder and are in the
+    UoA. Funders overlap and a study can have many terms, so counts can't be
+    added up along an axis; instead each axis has members that count distinct
+    case studies across it: ANY_TERM and ALL_STUDIES on the term axis, ANYWHERE on
+    the place axis and ALL on the funder and UoA axes. The term axis also has a
+    MATCHING_WORDS member for each number of (term, place) matches a study can
+    have, which counts the studies with exactly that many matches in total.
+
+    Counts from different chunks of the same case studies can be added together.
+    The counts of a weighted sample are sums of weights, which are kept as they
+    are while chunks are added and only rounded when they are selected, so that
+    a cube added up a chunk at a time gives the same counts as one built at once.
+    """
+
+    def __init__(self, coords, counts):
+        self.coords = coords
+        self.counts = counts
+
+    def add(self, other):
+        """Add the counts of another cube with the same members, e.g. from another chunk of the case studies."""
+        if other.coords != self.coords:
+            raise ValueError('Cannot add count cubes with different members')
+        # Not added in place, so adding a weighted cube to an unweighted one keeps the fractions
+        self.counts = self.counts + other.counts
+
+    def positions(self, dim, members):
+        """Find the positions of members of an axis.
+
+        :params: the name of an axis and a member or list of members of it
+        :return: a position, or a list of positions if members is a list
+        """
+        if isinstance(members, list):
+            return [self.coords[dim].index(member) for member in members]
+
+        return self.coords[dim].index(members)
+
+    def select(self, **selections):
+        """Take a slice of the cube.
+
+        Each keyword names an axis and gives a member of it, which drops that
+        axis, or a list of members, which keeps it. Axes that aren't named are
+        kept in full
+        :params: keywords of axis name to member or list of members
+        :return: an int if every axis was dropped, a series if one axis is left, a dataframe
+                 (indexed by the first axis left) if two axes are left, or a series with a
+                 MultiIndex if there are more
+        """
+        unknown = set(selections) - set(DIMS)
+        if unknown:
+            raise KeyError('Unknown axes: ' + ', '.join(sorted(unknown)))
+
+        counts = self.counts
+        kept = []
+        # Select from the last axis first, so the positions of the earlier axes don't change
+        for axis in reversed(range(len(DIMS))):
+            dim = DIMS[axis]
+            if dim not in selections:
+                kept.insert(0, (dim, self.coords[dim]))
+            elif isinstance(selections[dim], list):
+                counts = counts.take(self.positions(dim, selections[dim]), axis=axis)
+                kept.insert(0, (dim, selections[dim]))
+            else:
+                counts = counts.take(self.positions(dim, selections[dim]), axis=axis)
+
+        # Weighted counts are rounded to whole case studies once they're selected
+        if counts.dtype.kind == 'f':
+            counts = np.rint(counts).astype(np.int64)
+
+        if not kept:
+            return int(counts)
+        if len(kept) == 1:
+            return pd.Series(counts, index=pd.Index(kept[0][1], name=kept[0][0]))
+        if len(kept) == 2:
+            return pd.DataFrame(counts, index=pd.Index(kept[0][1], name=kept[0][0]),
+                                columns=pd.Index(kept[1][1], name=kept[1][0]))
+
+        index = pd.MultiIndex.from_product([members for _, members in kept], names=[dim for dim, _ in kept])
+        return pd.Series(counts.ravel(), index=index)
+
+    def crosstab(self, rows, cols, **selections):
+        """Cross-tabulate two axes of the cube, leaving out the members that count across an axis.
+
+        For example crosstab('funder', 'uoa', term=ANY_TERM, place=ANYWHERE) gives
+        the software-related studies of each funder in each UoA
+        :params: the axis to use for the rows, the axis to use for the cols, and a member of each other axis
+        :return: a dataframe
+        """
+        selections = dict(selections)
+        selections[rows] = [member for member in self.coords[rows] if not is_margin(member)]
+        selections[cols] = [member for member in self.coords[cols] if not is_margin(member)]
+        crosstab = self.select(**selections)
+        if DIMS.index(rows) > DIMS.index(cols):
+            crosstab = crosstab.T
+
+        return crosstab
+
+
+def is_matching_words(member):
+    """Check whether a member of the term axis is a MATCHING_WORDS member."""
+    prefix, suffix = MATCHING_WORDS.split('{}')
+
+    return member.startswith(prefix) and member.endswith(suffix)
+
+
+def is_margin(member):
+    """Check whether a member of an axis counts across the axis rather than being a term, place, funder or UoA."""
+    return member in (ANY_TERM, ALL_STUDIES, ANYWHERE, ALL) or is_matching_words(member)
+
+
+def build_count_cube(hit_array, terms, places, funders, funder_names, uoa_codes, list_of_uoas, max_matches, weights=None):
+    """Count the case studies by term, place, funder and Unit of Assessment in one pass.
+
+    Which terms were found where in each study is laid out as a row of a
+    (term, place) matrix, and the cube is the product of those rows with the
+    funders of each study, taken separately for the studies in each UoA. The
+    studies are added a block at a time. When the studies are a weighted
+    sample, each is counted as its weight, and the counts are kept as sums
+    of weights until they are selected
+    :params: a [study, term, place] boolean hit array with the terms and places of its axes, a
+             [study, funder] boolean array with the names of its funders, the code of each
+             study's UoA in list_of_uoas (-1 for none), the list of UoAs, the largest number of
+             (term, place) matches to have a MATCHING_WORDS member for, and optionally the weight of each study
+    :return: a CountCube
+    """
+    matches = list(range(2, max_matches + 1))
+    coords = {'term': list(terms) + [ANY_TERM] + [MATCHING_WORDS.format(n) for n in matches] + [ALL_STUDIES],
+              'place': list(places) + [ANYWHERE],
+              'funder': list(funder_names) + [ALL],
+              'uoa': list(list_of_uoas) + [ALL]}
+
+    term_place_count = len(coords['term']) * len(coords['place'])
+    # Studies in no known UoA are counted in an extra slot, which is replaced by the ALL slot at the end
+    counts = np.zeros((len(list_of_uoas) + 1, term_place_count, len(coords['funder'])))
+
+    for start in range(0, len(hit_array), CUBE_BLOCK_SIZE):
+        block = hit_array[start:start + CUBE_BLOCK_SIZE]
+        found = np.concatenate([block, block.any(axis=2)[:, :, np.newaxis]], axis=2)
+        found_any_term = found.any(axis=1)
+        match_count = block.sum(axis=(1, 2))
+
+        # Each study's row of the (term, place) matrix
+        rows = np.concatenate([found, found_any_term[:, np.newaxis, :]] +
+                              [((match_count == n)[:, np.newaxis] & found_any_term)[:, np.newaxis, :] for n in matches] +
+                              [np.ones_like(found_any_term)[:, np.newaxis, :]], axis=1)
+        rows = rows.reshape(len(block), -1).astype(np.float64)
+        if weights is not None:
+            rows *= np.asarray(weights[start:start + CUBE_BLOCK_SIZE], dtype=np.float64)[:, np.newaxis]
+
+        block_funders = np.concatenate([funders[start:start + CUBE_BLOCK_SIZE],
+                                        np.ones((len(block), 1), dtype=bool)], axis=1).astype(np.float64)
+
+        block_uoas = uoa_codes[start:start + CUBE_BLOCK_SIZE] % (len(list_of_uoas) + 1)
+        for uoa in np.unique(block_uoas):
+            in_uoa = block_uoas == uoa
+            counts[uoa] += rows[in_uoa].T.dot(block_funders[in_uoa])
+
+    counts[-1] = counts.sum(axis=0)
+    if weights is None:
+        counts = counts.astype(np.int64)
+
+    # Lay the counts out as [term, place, funder, uoa]
+    counts = counts.reshape(len(coords['uoa']), len(coords['term']), len(coords['place']), len(coords['funder']))
+
+    return CountCube(coords, counts.transpose(1, 2, 3, 0).copy())
+
+
+def save_count_cube(cube, filename=CUBE_FILENAME):
+    """Save a count cube, replacing any earlier one in a single step.
+
+    :params: a CountCube and a filename
+    :return: nothing, saves a pickle
+    """
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(cube, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+
+def load_count_cube(filename=CUBE_FILENAME):
+    """Load a count cube saved by save_count_cube.
+
+    :params: a filename
+    :return: a CountCube
+    """
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-tabulate the case studies from the count cube saved by '
+                                                 'ref_case_studies.py, without reading the case studies again.')
+    parser.add_argument('rows', nargs='?', default='funder', choices=DIMS)
+    parser.add_argument('cols', nargs='?', default='uoa', choices=DIMS)
+    parser.add_argument('--term', default=ANY_TERM, help='the term to count the studies of, if it isn\'t an axis')
+    parser.add_argument('--place', default=ANYWHERE, help='the place to count the studies of, if it isn\'t an axis')
+    parser.add_argument('--funder', default=ALL, help='the funder col to count the studies of, if it isn\'t an axis')
+    parser.add_argument('--uoa', default=ALL, help='the UoA to count the studies of, if it isn\'t an axis')
+    args = parser.parse_args()
+
+    if args.rows == args.cols:
+        parser.error('the rows and cols must be different axes')
+
+    cube = load_count_cube()
+    selections = dict((dim, getattr(args, dim)) for dim in DIMS if dim not in (args.rows, args.cols))
+    crosstab = cube.crosstab(args.rows, args.cols, **selections)
+
+    filename = 'crosstab_' + args.rows + '_by_' + args.cols
+    crosstab.to_csv(RESULT_STORE + filename + '.csv')
+    print(crosstab.to_string())
+    print('saved to ' + RESULT_STORE + filename + '.csv')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import hashlib
+import pickle
+import numpy as np
+
+# Other global variables
+HIT_CACHE_STORE = "input/generated/hit_cache/"
+# The hashes of the corpora, kept so an untouched corpus isn't read again to hash it. Each
+# corpus has its own file in this dir, so processes hashing different corpora don't overwrite each other
+HASHES_DIR = "corpus_hashes"
+# How many versions of the corpus (or different corpora) keep a hit cache. The
+# caches used least recently are removed first
+MAX_HIT_CACHES = 8
+
+
+def file_content_hash(filename, block_size=1 << 20):
+    """Hash the contents of a file.
+
+    :params: a filename
+    :return: a hex digest that changes whenever the contents of the file change
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def hashes_filename_for(filename, cache_dir=HIT_CACHE_STORE):
+    """Find the file the hash of a corpus is kept in.
+
+    :params: a csv filename and the directory the caches are kept in
+    :return: a filename named after a hash of the full path of the corpus
+    """
+    path_hash = hashlib.sha1(os.path.realpath(filename).encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_dir, HASHES_DIR, path_hash + '.json')
+
+
+def corpus_hash_for(filename, cache_dir=HIT_CACHE_STORE):
+    """Hash the contents of a corpus, unless it hasn't been touched since it was last hashed.
+
+    As with pipeline.FileHasher, a file whose size and modification time are the
+    same as when it was last hashed is not read again
+    :params: a csv filename and the directory the caches are kept in
+    :return: a hex digest of the contents of the file
+    """
+    stat = os.stat(filename)
+    fingerprint = [stat.st_size, stat.st_mtime]
+    path = os.path.realpath(filename)
+
+    hashes_filename = hashes_filename_for(filename, cache_dir)
+    if os.path.exists(hashes_filename):
+        try:
+            with open(hashes_filename) as f:
+                known = json.load(f)
+            if known['path'] == path and known['fingerprint'] == fingerprint:
+                return known['hash']
+        except (ValueError, KeyError):
+            # Not a file this function wrote, so hash the corpus again and replace it
+            pass
+
+    content_hash = file_content_hash(filename)
+    os.makedirs(os.path.dirname(hashes_filename), exist_ok=True)
+    # Only this corpus is recorded in the file, so a process hashing another corpus at
+    # the same time can't undo it, and the file is moved into place whole
+    temp_filename = hashes_filename + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filename, 'w') as f:
+        json.dump({'path': path, 'fingerprint': fingerprint, 'hash': content_hash}, f, indent=1, sort_keys=True)
+    os.replace(temp_filename, hashes_filename)
+
+    return content_hash
+
+
+def normalize_term(term):
+    """Put a search term into the form used as a cache key.
+
+    :params: a search term
+    :return: the term lowercased, with runs of whitespace collapsed to a single space
+    """
+    return ' '.join(term.lower().split())
+
+
+class HitCache(object):
+    """Where each search term was found in each search place of one version of the corpus.
+
+    Hits are stored per (normalized term, search place), as a boolean array
+    with one entry per case study, so that a re-run only has to search for the
+    terms that have been added since the last run. The cache is keyed on a hash
+    of the corpus, so a changed corpus starts a new cache.
+    """
+
+    def __init__(self, corpus_hash, case_study_ids):
+        self.corpus_hash = corpus_hash
+        self.case_study_ids = np.asarray(case_study_ids)
+        self.hits = {}
+
+    def missing_terms(self, terms, search_places):
+        """Find which terms have not been searched for in every search place yet.
+
+        :params: a list of search terms and a list of search places
+        :return: a list of the terms that still have to be searched for
+        """
+        return [term for term in terms
+                if any((normalize_term(term), place) not in self.hits for place in search_places)]
+
+    def get(self, term, place):
+        """Get the hits of a term in a place.
+
+        :params: a search term and a search place
+        :return: a boolean array with an entry per case study
+        """
+        return self.hits[(normalize_term(term), place)]
+
+    def put(self, term, place, found):
+        """Record the hits of a term in a place.
+
+        :params: a search term, a search place and a boolean array with an entry per case study
+        :return: nothing
+        """
+        self.hits[(normalize_term(term), place)] = np.asarray(found, dtype=bool)
+
+
+def cache_filename_for(corpus_hash, cache_dir=HIT_CACHE_STORE):
+    """Find the file the hit cache for a version of the corpus is kept in."""
+    return os.path.join(cache_dir, corpus_hash + '.pickle')
+
+
+def load_hit_cache(corpus_hash, case_study_ids, cache_dir=HIT_CACHE_STORE):
+    """Load the hit cache for a version of the corpus, or start a new one.
+
+    :params: the hash of the corpus, its Case Study Ids in row order and the directory the caches are kept in
+    :return: a HitCache
+    """
+    filename = cache_filename_for(corpus_hash, cache_dir)
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            cache = pickle.load(f)
+        if np.array_equal(cache.case_study_ids, np.asarray(case_study_ids)):
+            # Mark the cache as used, so it is the last to be removed
+            os.utime(filename)
+            return cache
+
+    return HitCache(corpus_hash, case_study_ids)
+
+
+def save_hit_cache(cache, cache_dir=HIT_CACHE_STORE, max_caches=MAX_HIT_CACHES):
+    """Save a hit cache, keeping the caches of other versions of the corpus and of other corpora.
+
+    Only the caches beyond the max_caches most recently used are removed
+    :params: a HitCache, the directory the caches are kept in and how many caches to keep
+    :return: nothing, saves a pickle
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    filename = cache_filename_for(cache.corpus_hash, cache_dir)
+    temp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, filename)
+
+    caches = []
+    for other in os.listdir(cache_dir):
+        if other.endswith('.pickle'):
+            try:
+                caches.append((os.path.getmtime(os.path.join(cache_dir, other)), other))
+            except OSError:
+                # Removed by another process
+                pass
+    for _, old_cache in sorted(caches, reverse=True)[max_caches:]:
+        try:
+            os.remove(os.path.join(cache_dir, old_cache))
+        except OSError:
+            pass
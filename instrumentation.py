@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import functools
+import threading
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS isn't recorded
+    resource = None
+
+# Set this environment variable to a filename to record a trace of each run.
+# The trace is in the Chrome trace event format, so it can be opened in
+# chrome://tracing or https://ui.perfetto.dev as well as read as JSON
+TRACE_ENV_VAR = 'REF_TRACE_FILE'
+# Set by the process that starts a trace, and inherited by any processes it starts,
+# so they know which process writes the trace and when the trace started
+TRACE_PARENT_ENV_VAR = 'REF_TRACE_PARENT'
+TRACE_START_ENV_VAR = 'REF_TRACE_START'
+
+_events = []
+_lock = threading.Lock()
+
+
+def tracing_enabled():
+    """Check whether a trace is being recorded.
+
+    :return: True if the trace environment variable is set
+    """
+    return bool(os.environ.get(TRACE_ENV_VAR))
+
+
+def is_trace_parent():
+    """Check whether this is the process that writes the trace, rather than a worker it started.
+
+    :return: True if this process started the trace
+    """
+    return os.environ.get(TRACE_PARENT_ENV_VAR) == str(os.getpid())
+
+
+def worker_events_filename(pid):
+    """Find the file the stages of a worker process are added to, until the trace is written.
+
+    :params: the pid of the worker
+    :return: a filename next to the trace file
+    """
+    return os.environ[TRACE_ENV_VAR] + '.' + str(pid) + '.jsonl'
+
+
+if tracing_enabled() and TRACE_PARENT_ENV_VAR not in os.environ:
+    # This process starts the trace. Workers inherit these, whether they are forked or spawned
+    os.environ[TRACE_PARENT_ENV_VAR] = str(os.getpid())
+    os.environ[TRACE_START_ENV_VAR] = repr(time.time())
+    for stale in glob.glob(glob.escape(os.environ[TRACE_ENV_VAR]) + '.*.jsonl'):
+        os.remove(stale)
+_start = float(os.environ.get(TRACE_START_ENV_VAR, time.time()))
+
+
+def peak_rss_kb():
+    """Find the peak resident set size of this process so far (ru_maxrss).
+
+    This is the peak over the life of the process, not of a single stage
+    :return: the peak RSS in kilobytes, or None if it can't be found
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes
+    if sys.platform == 'darwin':
+        peak //= 1024
+
+    return peak
+
+
+def child_cpu_seconds():
+    """Find the CPU time used by the child processes of this process that have finished.
+
+    :return: the user plus system CPU seconds of the children, or 0 if it can't be found
+    """
+    if resource is None:
+        return 0
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def describe(value):
+    """Describe the size of a dataframe or series.
+
+    :params: any value
+    :return: a dict of the shape and bytes of a dataframe or series, or None for anything else
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return {'shape': list(value.shape), 'bytes': int(np.sum(value.memory_usage(deep=True)))}
+
+    return None
+
+
+class Stage(object):
+    """A context manager recording one named stage in the trace.
+
+    Records the wall time and CPU time of the stage (including that of any
+    worker processes it started and waited for), the peak RSS of the process
+    so far, and the sizes of any dataframes passed in or handed to record().
+    Measuring a dataframe can take a while, so record() should be called
+    before the stage is entered or after it has finished where possible. A
+    stage in a worker process is added to a file of that worker's stages
+    straight away, because workers may exit without running atexit handlers,
+    and the files are merged into the trace when it is written. Does nothing
+    unless tracing is enabled.
+    """
+
+    def __init__(self, name, **dataframes):
+        self.name = name
+        self.args = {}
+        self.enabled = tracing_enabled()
+        if self.enabled:
+            self.record(**dataframes)
+
+    def record(self, **dataframes):
+        """Record the sizes of some dataframes against this stage.
+
+        :params: dataframes as keyword arguments, named as they should appear in the trace
+        :return: nothing
+        """
+        if not self.enabled:
+            return
+        for name, value in dataframes.items():
+            description = describe(value)
+            if description is not None:
+                self.args[name] = description
+
+    def __enter__(self):
+        if self.enabled:
+            self.ts = time.time()
+            self.wall_start = time.perf_counter()
+            self.cpu_start = time.process_time()
+            self.child_cpu_start = child_cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return False
+
+        wall_end = time.perf_counter()
+        child_cpu = child_cpu_seconds() - self.child_cpu_start
+        self.args['cpu seconds'] = time.process_time() - self.cpu_start + child_cpu
+        self.args['child process cpu seconds'] = child_cpu
+        self.args['process peak rss kb (ru_maxrss)'] = peak_rss_kb()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        event = {'name': self.name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                 'ts': (self.ts - _start) * 1e6, 'dur': (wall_end - self.wall_start) * 1e6,
+                 'args': self.args}
+        if is_trace_parent():
+            with _lock:
+                _events.append(event)
+        else:
+            with _lock, open(worker_events_filename(os.getpid()), 'a') as f:
+                f.write(json.dumps(event) + '\n')
+
+        return False
+
+
+def traced(func):
+    """Decorate a function so that each call of it is recorded as a stage in the trace.
+
+    The sizes of any dataframes passed to the function or returned by it are
+    recorded, outside the timed part of the stage
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracing_enabled():
+            return func(*args, **kwargs)
+
+        current = Stage(func.__name__)
+        current.record(**dict(('arg ' + str(i), arg) for i, arg in enumerate(args)))
+        current.record(**kwargs)
+        with current:
+            result = func(*args, **kwargs)
+        # The event shares the args dict, so the result can be added once the stage is over
+        current.record(result=result)
+
+        return result
+
+    return wrapper
+
+
+def write_trace(filename=None):
+    """Write the stages recorded so far, including those of any worker processes, to the trace file.
+
+    :params: optionally the trace filename, which defaults to the trace environment variable
+    :return: nothing, saves a JSON file
+    """
+    filename = filename or os.environ.get(TRACE_ENV_VAR)
+    if not filename:
+        return
+
+    worker_events = []
+    for events_filename in glob.glob(glob.escape(os.environ.get(TRACE_ENV_VAR, filename)) + '.*.jsonl'):
+        with open(events_filename) as f:
+            worker_events.extend(json.loads(line) for line in f if line.strip())
+        os.remove(events_filename)
+
+    with _lock:
+        _events.extend(worker_events)
+        trace = {'traceEvents': sorted(_events, key=lambda event: event['ts']), 'displayTimeUnit': 'ms',
+                 'otherData': {'command': ' '.join(sys.argv)}}
+    with open(filename, 'w') as f:
+        json.dump(trace, f, indent=1)
+
+
+@atexit.register
+def _write_trace_at_exit():
+    # Only the process that started the trace writes it
+    if tracing_enabled() and is_trace_parent():
+        write_trace()
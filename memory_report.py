@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import pandas as pd
+
+import ref_case_studies
+import organise_studies_by_funder
+from ref_case_studies import SoftwareSearchTerms
+from term_matching import TermMatcher
+from instrumentation import describe
+
+# Other global variables
+DATAFILENAME = "input/generated/all_ref_case_study_data.csv"
+STUDIES_BY_FUNDER = "input/generated/list_of_studies_by_council.csv"
+RESULT_STORE = "outputs/"
+
+SEARCH_PLACES = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+
+
+def funders_as_strings(df_studies_by_funder, funder_cols):
+    """Lay out a funder membership table as it used to be, with the funder name or NaN in each funder col.
+
+    :params: a boolean funder membership table and a list of its funder cols
+    :return: a dataframe with an object col for each funder
+    """
+    old_df = df_studies_by_funder.copy()
+    for col in funder_cols:
+        old_df[col] = pd.Series(col, index=old_df.index).where(old_df[col])
+
+    return old_df
+
+
+def count_funders(df, cols_to_search):
+    """Count the studies linked to each funder.
+
+    :params: a dataframe and a list of its funder cols
+    :return: a series with a count for each funder col
+    """
+    # Create temp df containing only the cols to be searched and count the studies linked to each funder.
+    # Studies that no funder is linked to have NaN rather than False in the funder cols
+    temp_df = df[cols_to_search]
+
+    return temp_df.fillna(False).astype(bool).sum()
+
+
+def funders_as_long(df_studies_by_funder, funder_cols):
+    """Lay out a funder membership table as read_data does, one row per study and funder.
+
+    :params: a boolean funder membership table and a list of its funder cols
+    :return: a dataframe with a Case Study Id col and an object funder col
+    """
+    long_df = pd.melt(df_studies_by_funder, id_vars=['Case Study Id'], value_vars=funder_cols, var_name='funder')
+
+    return long_df[long_df['value'].astype(bool)][['Case Study Id', 'funder']].reset_index(drop=True)
+
+
+def found_in_cols_as_strings(hits):
+    """Expand a hit matrix into the found_in cols as they used to be, with a string or NaN per case study.
+
+    :params: a hit matrix from find_terms_in_places
+    :return: a dataframe laid out like hits_to_found_in_cols, with object cols
+    """
+    found_in_cols = {}
+    for term, place in hits.columns:
+        found_in_cols[term + '_found_in_' + place] = pd.Series(place, index=hits.index).where(hits[(term, place)])
+    found_in_cols['any_term_found_in_anywhere'] = pd.Series('anywhere', index=hits.index).where(hits.any(axis=1))
+    found_in_cols['search terms found'] = hits.sum(axis=1)
+
+    return pd.DataFrame(found_in_cols, index=hits.index)
+
+
+def funder_cols_with_nan(df, funder_cols):
+    """Lay out the funder cols of the case studies as the merge used to leave them, True or NaN.
+
+    :params: a dataframe and a list of its funder cols
+    :return: a dataframe with an object col for each funder
+    """
+    old_df = df.copy()
+    for col in funder_cols:
+        old_df[col] = old_df[col].astype(object).where(old_df[col].fillna(False).astype(bool))
+
+    return old_df
+
+
+def compare(name, old_df, new_df, output):
+    """Compare the memory used by the old and new layouts of a dataframe.
+
+    The output that each layout feeds into is also made from both, to check
+    that the compact layout gives exactly the same results
+    :params: the name of the dataframe, the dataframe in its old and its new layout, and
+             a function making the output the dataframe is used for (a summary or a csv file)
+    :return: a dict of the bytes used by each layout and whether their outputs are the same
+    """
+    old_bytes = describe(old_df)['bytes']
+    new_bytes = describe(new_df)['bytes']
+    old_output = output(old_df)
+    new_output = output(new_df)
+    if isinstance(new_output, pd.Series):
+        same_output = old_output.equals(new_output)
+    else:
+        same_output = old_output == new_output
+
+    return {'dataframe': name, 'rows': len(new_df), 'cols': len(new_df.columns),
+            'old bytes': old_bytes, 'new bytes': new_bytes,
+            '% reduction': round(100 * (1 - new_bytes / float(old_bytes)), 1),
+            'same output': same_output}
+
+
+def main():
+    df_studies_by_funder = ref_case_studies.import_csv_to_df(STUDIES_BY_FUNDER)
+    funder_cols = ref_case_studies.get_col_list(df_studies_by_funder, 'funder')
+    df_studies_by_funder = ref_case_studies.compact_funder_cols(df_studies_by_funder, funder_cols)
+
+    rows = []
+
+    # The funders of each study, as read from the funders' Excel files
+    long_df = funders_as_long(df_studies_by_funder, funder_cols)
+    compact_long_df = long_df.copy()
+    compact_long_df['funder'] = compact_long_df['funder'].astype('category')
+    rows.append(compare('studies by funder (long)', long_df, compact_long_df,
+                        lambda df: organise_studies_by_funder.clean(df).to_csv()))
+
+    # The funder membership table
+    rows.append(compare('list_of_studies_by_council', funders_as_strings(df_studies_by_funder, funder_cols),
+                        df_studies_by_funder, lambda df: count_funders(df, funder_cols)))
+
+    # The funder cols of the case studies, as used by count_cube_for
+    df = ref_case_studies.import_csv_to_df(DATAFILENAME, ['Case Study Id'] + SEARCH_PLACES + funder_cols)
+    df_funders = df[['Case Study Id'] + funder_cols]
+    rows.append(compare('case study funder cols', funder_cols_with_nan(df_funders, funder_cols),
+                        ref_case_studies.compact_funder_cols(df_funders.copy(), funder_cols),
+                        lambda df: count_funders(df, funder_cols)))
+
+    # The found_in cols of the export
+    matcher = TermMatcher(SoftwareSearchTerms().data)
+    hits = ref_case_studies.find_terms_in_places(df, matcher, SEARCH_PLACES)
+    rows.append(compare('found_in cols', found_in_cols_as_strings(hits), ref_case_studies.hits_to_found_in_cols(hits),
+                        lambda df: df.to_csv()))
+
+    report = pd.DataFrame(rows, columns=['dataframe', 'rows', 'cols', 'old bytes', 'new bytes', '% reduction', 'same output'])
+    report.set_index('dataframe', inplace=True)
+    print(report.to_string())
+    report.to_csv(RESULT_STORE + 'memory_report.csv')
+
+
+if __name__ == '__main__':
+    main()
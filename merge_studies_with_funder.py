@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
+from corpus_cache import read_cached_csv
+from instrumentation import traced
+
 # Other global variables
 DATAFILENAME = "input/raw/CaseStudies.xlsx"
 STUDIES_BY_FUNDER = "input/generated/list_of_studies_by_council.csv"
 RESULT_STORE = "input/generated/"
+# How many processes to clean the data with (None is one per CPU), and how many rows each is handed at a time
+CLEANING_PROCESSES = None
+CLEANING_CHUNK_SIZE = 1000
 
 
+@traced
 def import_xls_to_df(filename, name_of_sheet):
     """Imports an Excel file into a Pandas dataframe.
 
@@ -18,6 +26,7 @@ def import_xls_to_df(filename, name_of_sheet):
     return pd.read_excel(filename, sheetname=name_of_sheet)
 
 
+@traced
 def import_csv_to_df(filename):
     """Imports a csv file into a Pandas dataframe.
 
@@ -25,9 +34,10 @@ def import_csv_to_df(filename):
     :return: a df
     """
 
-    return pd.read_csv(filename)
+    return read_cached_csv(filename)
 
 
+@traced
 def export_to_csv(df, location, filename):
     """Exports a df to a csv file.
 
@@ -38,51 +48,107 @@ def export_to_csv(df, location, filename):
     return df.to_csv(location + filename + '.csv')
 
 
-def clean(dataframe):
-    """Cleans the imported data for easy processing.
+def clean_text_column(series):
+    """Cleans one column of the imported data.
+
+    Collapses each run of whitespace (including line breaks) to a single space,
+    strips and lowercases every string in the column, using vectorized string
+    methods rather than a Python function per cell. Cells that are not strings
+    are left as they are
+
+    :params: a series
+    :return: a cleaned series
+    """
+    is_str = series.map(lambda x: isinstance(x, str))
+    if not is_str.any():
+        return series
+
+    series = series.copy()
+    series[is_str] = series[is_str].str.replace(r'\s+', ' ', regex=True).str.strip().str.lower()
 
-    Removes end of lines chars, multiple spaces, and lowercases everything
+    return series
 
+
+def get_text_cols(dataframe):
+    """Find the cols that can hold strings.
+
+    These are the cols of Python objects, and the string cols of versions of
+    pandas that have a string dtype. Integer, boolean and categorical cols are left out
     :params: a dataframe
-    :return: a dataframe with clean data
+    :return: a list of cols
     """
+    return [col for col in dataframe.columns
+            if dataframe[col].dtype == object or str(dataframe[col].dtype) in ('string', 'str')]
 
-    # Someone thought it would be a good idea to add line breaks
-    # to the longer strings in Excel - this removes them
-    dataframe = dataframe.replace(to_replace='\n', value=' ', regex=True)
 
-    # There are also multiple spaces in the strings - this removes them
-    dataframe = dataframe.replace('\s+', ' ', regex=True)
+def clean_chunk(dataframe):
+    """Cleans the text columns of some rows of the imported data.
 
-    # And now to remove the leading spaces and lowercase everything
-    # Need to do this conditionally since some of the cols have integers
-    for col in dataframe.columns:
-        dataframe[col] = dataframe[col].map(lambda x: x.strip().lower() if isinstance(x, str) else x)
+    :params: a dataframe
+    :return: a dataframe with clean data
+    """
+    dataframe = dataframe.copy()
+
+    # Only the text cols can hold strings, so integer cols are skipped
+    for col in get_text_cols(dataframe):
+        dataframe[col] = clean_text_column(dataframe[col])
 
     return dataframe
 
 
+@traced
+def clean(dataframe, processes=1, chunk_size=CLEANING_CHUNK_SIZE):
+    """Cleans the imported data for easy processing.
+
+    Removes end of lines chars, multiple spaces, and lowercases everything.
+    Someone thought it would be a good idea to add line breaks to the longer
+    strings in Excel, and there are also multiple spaces in the strings, so every
+    run of whitespace becomes a single space before stripping and lowercasing
+
+    :params: a dataframe, and optionally the number of processes to spread chunks
+             of chunk_size rows across (None is one per CPU)
+    :return: a dataframe with clean data
+    """
+    if processes == 1 or len(dataframe) <= chunk_size:
+        return clean_chunk(dataframe)
+
+    chunks = [dataframe.iloc[start:start + chunk_size] for start in range(0, len(dataframe), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        chunks = list(executor.map(clean_chunk, chunks))
+
+    return pd.concat(chunks)
+
+
+@traced
 def associate_new_data(dataframe, df_studies_by_funder):
     """Merge two dataframes based on Case Study ID.
 
     Takes a dataframe with the case study information and merges it with another
     dataframe that contains case study IDs and some other data (e.g. funders, disciplines)
 
+    Case studies that no funder is linked to have no row in df_studies_by_funder,
+    so the merge leaves their boolean cols empty. These are filled with False, so
+    the cols stay boolean rather than becoming cols of Python objects
     :params: a dataframe with case study information, a second dataframe with cases study IDs and other information
     :return: a dataframe containing case study information and other merged information
     """
 
     dataframe = pd.merge(left=dataframe, right=df_studies_by_funder, how='left', left_on='Case Study Id', right_on='Case Study Id')
 
+    bool_cols = [col for col in df_studies_by_funder.columns if df_studies_by_funder[col].dtype == bool]
+    if bool_cols:
+        dataframe[bool_cols] = dataframe[bool_cols].fillna(False).astype(bool)
+
     return dataframe
 
 
+@traced
 def main():
     # Import dataframe from original xls
     df = import_xls_to_df(DATAFILENAME, 'CaseStudies')
 
-    # Clean data
-    df = clean(df)
+    # Clean data, a chunk of rows per process
+    df = clean(df, CLEANING_PROCESSES)
 
     # Import case study ids for each funder
     df_studies_by_funder = import_csv_to_df(STUDIES_BY_FUNDER)
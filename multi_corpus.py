@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import re
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Add search terms from policy_common_data submodule repo
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "lib", "policy_common_data"))
+from commondata.softwaresearchterms import SoftwareSearchTerms
+
+import ref_case_studies
+from term_matching import TermMatcher
+from count_cube import ANY_TERM, ANYWHERE, ALL, ALL_STUDIES, load_count_cube
+from result_export import export_tables
+from instrumentation import traced
+
+# Other global variables
+# A JSON list of the corpora to analyse side by side, as described in load_corpora
+CORPORA_FILENAME = "input/corpora.json"
+RESULT_STORE = "outputs/corpora/"
+# How many corpora are analysed at once (None is one process per corpus)
+CORPUS_PROCESSES = None
+# The summaries compared across the corpora: the name of the comparison, the summary, its col of
+# software reliant case studies, and its col of all case studies (None for all the case studies in the corpus)
+COMPARISONS = [('word_popularity', 'summary_of_word_popularity', 'count', None),
+               ('funders', 'summary_of_funders', 'count', None),
+               ('uoas', 'summary_of_uoas', 'software reliant count', 'all studies count'),
+               ('panels', 'summary_of_panels', 'software reliant count', 'all studies count')]
+
+
+def load_corpora(filename=CORPORA_FILENAME):
+    """Read the definitions of the corpora to analyse.
+
+    Each corpus is a dict with a 'name', a csv file of its 'case_studies' in the
+    layout of all_ref_case_study_data.csv, a csv file of its 'units_of_assessment'
+    and their main panels, and optionally a csv file of its 'studies_by_funder'
+    (leave it out if the case studies have no funders) and a 'result_store' dir
+    (by default a dir named after the corpus in RESULT_STORE)
+    :params: a JSON file holding a list of corpora
+    :return: a list of corpus dicts, with every key filled in
+    """
+    with open(filename) as f:
+        corpora = json.load(f)
+
+    names = [corpus.get('name') for corpus in corpora]
+    if not corpora or None in names or len(set(names)) != len(names):
+        raise ValueError(filename + ' must list at least one corpus, each with a different name')
+
+    for corpus in corpora:
+        missing = [key for key in ['case_studies', 'units_of_assessment'] if key not in corpus]
+        if missing:
+            raise ValueError('Corpus ' + corpus['name'] + ' in ' + filename + ' has no ' + ', '.join(missing))
+        corpus.setdefault('studies_by_funder', None)
+        corpus.setdefault('result_store', RESULT_STORE + re.sub(r'[^\w.-]', '_', corpus['name']) + '/')
+
+    return corpora
+
+
+def analyse_one_corpus(corpus, matcher, search_terms, search_places):
+    """Analyse a corpus with ref_case_studies.py, for a worker process.
+
+    :params: a corpus dict from load_corpora, a TermMatcher holding the search terms, the list of
+             search terms and a list of search places
+    :return: a dict of summary name to summary dataframe, and a tuple of the number of case studies
+             in the corpus and the number with search terms identified
+    """
+    os.makedirs(corpus['result_store'], exist_ok=True)
+    summaries = ref_case_studies.analyse_corpus(corpus['case_studies'], corpus['studies_by_funder'], corpus['units_of_assessment'],
+                                                corpus['result_store'], matcher, search_terms, search_places)
+
+    cube = load_count_cube(corpus['result_store'] + 'count_cube.pickle')
+    totals = (cube.select(term=ALL_STUDIES, place=ANYWHERE, funder=ALL, uoa=ALL),
+              cube.select(term=ANY_TERM, place=ANYWHERE, funder=ALL, uoa=ALL))
+
+    return summaries, totals
+
+
+@traced
+def analyse_corpora(corpora, search_terms, search_places, processes=CORPUS_PROCESSES):
+    """Analyse several corpora at once, with the search terms compiled once for all of them.
+
+    Each corpus is analysed in its own process, so the whole run takes about
+    as long as the largest corpus
+    :params: a list of corpus dicts from load_corpora, the list of search terms, a list of search places
+             and the number of processes to use (None is one per corpus, 1 analyses them in this process)
+    :return: a list of the results of analyse_one_corpus, in the order of the corpora
+    """
+    matcher = TermMatcher(search_terms)
+
+    if processes == 1 or len(corpora) == 1:
+        return [analyse_one_corpus(corpus, matcher, search_terms, search_places) for corpus in corpora]
+
+    with ProcessPoolExecutor(max_workers=processes or len(corpora)) as executor:
+        futures = [executor.submit(analyse_one_corpus, corpus, matcher, search_terms, search_places) for corpus in corpora]
+
+        return [future.result() for future in futures]
+
+
+def compare_summaries(names, summaries, totals, summary_name, count_col, all_col=None):
+    """Put one summary of each corpus side by side, with the change in each percentage from the first corpus.
+
+    A corpus with nothing in the summary (e.g. no funders, because it has no
+    funder data) is left out, as a count of 0 for it would read as none of its
+    case studies being funded. A row that is only in the summaries of some of
+    the corpora counts 0 case studies in the rest
+    :params: a list of the names of the corpora, and lists of their summary dicts and totals from
+             analyse_one_corpus, the summary to compare, its col of software reliant case studies and
+             its col of all case studies (None for all the case studies in the corpus)
+    :return: a dataframe with a count and % col for each corpus that is compared, and a change col
+             for each of them after the first
+    """
+    compared = []
+    cols = []
+    for name, corpus_summaries, (all_case_study_count, _) in zip(names, summaries, totals):
+        summary = corpus_summaries[summary_name]
+        if summary.empty:
+            print('corpus ' + name + ' has nothing in its ' + summary_name + ', so it is left out of the comparison')
+            continue
+        all_counts = summary[all_col] if all_col else all_case_study_count
+        percentage = (100 * summary[count_col] / all_counts).round(1)
+        cols.extend([summary[count_col].rename(name + ' count'), percentage.rename(name + ' %')])
+        compared.append(name)
+        index_name = summary.index.name
+
+    if not compared:
+        return pd.DataFrame()
+
+    comparison = pd.concat(cols, axis=1).fillna(0)
+    for name in compared:
+        comparison[name + ' count'] = comparison[name + ' count'].astype(np.int64)
+    for name in compared[1:]:
+        comparison[name + ' change in % from ' + compared[0]] = (comparison[name + ' %'] - comparison[compared[0] + ' %']).round(1)
+
+    comparison.index.name = index_name
+    comparison.sort_values(compared[0] + ' %', ascending=False, inplace=True)
+
+    return comparison
+
+
+def compare_corpora(names, totals):
+    """Compare the share of the case studies in each corpus with search terms identified.
+
+    :params: a list of the names of the corpora and a list of their totals from analyse_one_corpus
+    :return: a dataframe with a row for each corpus
+    """
+    comparison = pd.DataFrame(list(totals), index=pd.Index(names, name='corpus'),
+                              columns=['all studies count', 'software reliant count'])
+    comparison['% of all studies'] = (100 * comparison['software reliant count'] / comparison['all studies count']).round(1)
+    comparison['change in % from ' + names[0]] = (comparison['% of all studies'] - comparison['% of all studies'].iloc[0]).round(1)
+
+    return comparison
+
+
+@traced
+def main():
+    parser = argparse.ArgumentParser(description='Analyse several corpora of case studies side by side.')
+    parser.add_argument('corpora', nargs='?', default=CORPORA_FILENAME, help='a JSON file listing the corpora')
+    parser.add_argument('--processes', type=int, default=CORPUS_PROCESSES, help='how many corpora to analyse at once')
+    args = parser.parse_args()
+
+    # The same places are searched as in ref_case_studies.py
+    possible_search_places = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+    search_terms = SoftwareSearchTerms().data
+
+    corpora = load_corpora(args.corpora)
+    results = analyse_corpora(corpora, search_terms, possible_search_places, args.processes)
+
+    names = [corpus['name'] for corpus in corpora]
+    summaries = [corpus_summaries for corpus_summaries, _ in results]
+    totals = [corpus_totals for _, corpus_totals in results]
+
+    comparisons = {'comparison_of_corpora': compare_corpora(names, totals)}
+    for comparison_name, summary_name, count_col, all_col in COMPARISONS:
+        comparisons['comparison_of_' + comparison_name] = compare_summaries(names, summaries, totals, summary_name,
+                                                                            count_col, all_col)
+    os.makedirs(RESULT_STORE, exist_ok=True)
+    export_tables(comparisons, RESULT_STORE)
+
+
+if __name__ == '__main__':
+    main()
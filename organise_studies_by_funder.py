@@ -2,64 +2,88 @@
 # encoding: utf-8
 
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
+from instrumentation import traced
+
 DATA_FILE_DIR = "input/raw/studies_by_council/"
 OUTPUT = "input/generated/"
 
 
-def read_data():
+def funder_name_for(datafile):
+    """Create the funder name by dropping the file extension from the filename, and then adding the keyword "funder_"."""
+
+    return 'funder_' + str(datafile)[:-5]
+
+
+def read_funder_file(datafile, data_file_dir=DATA_FILE_DIR):
+    """Read the case studies linked to one funder from its Excel file.
+
+    :params: the filename of an xlsx file and the dir it is in
+    :return: a dataframe with a Case Study Id col and a funder col naming the funder
+    """
+    funder = funder_name_for(datafile)
+
+    # Knock out everything except the case study
+    dataframe = pd.read_excel(data_file_dir + str(datafile), sheetname='CaseStudies')
+    dataframe = pd.DataFrame(dataframe['Case Study Id'])
+    dataframe['funder'] = funder
+
+    return dataframe
+
+
+@traced
+def read_data(max_workers=None, data_file_dir=DATA_FILE_DIR):
     """Create a summary dataframe based on concatenation of multiple Excel files.
 
-    Goes through all the xlsx files in the appropriate dir, converts each
-    one to a df and concatenates successively into a super df with all
-    the data
-    :params: none
-    :return: a dataframe formed from multiple dataframes
+    Goes through all the xlsx files in the appropriate dir, parsing them in
+    parallel in a pool of processes, and then concatenates them all at once
+    into a super df with all the data
+    :params: optionally the number of processes to use (defaults to one per CPU) and the dir of the xlsx files
+    :return: a dataframe with a row for each case study and funder pair
     """
-    new = True
-    for datafile in os.listdir(DATA_FILE_DIR):
-        if datafile.endswith('.xlsx'):
-            # Create the col name by dropping the file extension from the filename,
-            # and then adding the keyword "funder_"
-            new_col = 'funder_' + str(datafile)[:-5]
-
-            # Need this if loop because the first iternation has to be a straight read rather than a concatenation
-            if new:
-                dataframe = pd.read_excel(DATA_FILE_DIR + str(datafile), sheetname='CaseStudies')
-                dataframe = pd.DataFrame(dataframe['Case Study Id'])
-                dataframe[new_col] = new_col
-                new = False
-            else:
-                temp_df = pd.read_excel(DATA_FILE_DIR + str(datafile), sheetname='CaseStudies')
-                # Knock out everything except the case study
-                temp_df = pd.DataFrame(temp_df['Case Study Id'])
-                temp_df[new_col] = new_col
-                # Use concat to add temp dataframe onto end of the main dataframe
-                dataframe = pd.concat([dataframe, temp_df])
+    datafiles = sorted(datafile for datafile in os.listdir(data_file_dir) if datafile.endswith('.xlsx'))
+
+    # Parsing xlsx files is CPU bound, so use processes rather than threads
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        dataframes = list(executor.map(read_funder_file, datafiles, [data_file_dir] * len(datafiles)))
+
+    # A single concat, rather than one per file, so each row is only copied once
+    dataframe = pd.concat(dataframes, ignore_index=True)
+
+    # Every row of a funder holds the same name, so keep the names as a categorical.
+    # Every funder file is a category, even one that links no case studies
+    dataframe['funder'] = pd.Categorical(dataframe['funder'], categories=[funder_name_for(datafile) for datafile in datafiles])
 
     return dataframe
 
 
+@traced
 def clean(dataframe):
-    """Collapses the rows to produce a clean dataframe.
+    """Collapses the rows to produce a funder membership table.
 
     There will be one only instance of each Case Id and in that row there will be
-    at least one funder identified
+    a boolean col for each funder that is True if that funder is linked to the case study
     :params: a dataframe with - potentially - multiple instances of a Case Id each
     corresponding to a funder
-    :return: a dataframe with only one instance of each Case Id
+    :return: a dataframe with only one instance of each Case Id, and a col for every funder
+    (every category, if the funder col is a categorical)
     """
+    funders = dataframe['funder']
+    funder_cols = list(funders.cat.categories) if str(funders.dtype) == 'category' else sorted(funders.unique())
 
-    # Fill na's as blanks, because the .agg part of the function won't accept
-    # other ways of expressing na
-    dataframe = dataframe.fillna('')
-    # Collapse the rows
-    dataframe = dataframe.groupby('Case Study Id').agg(''.join)
+    # Count the rows for each case study and funder pair, which is more
+    # than zero wherever a funder is linked to the case study. A funder
+    # linked to no case studies has no col in the crosstab, so it's put back as all False
+    dataframe = pd.crosstab(dataframe['Case Study Id'], funders) > 0
+    dataframe = dataframe.reindex(columns=funder_cols, fill_value=False)
+    dataframe.columns.name = None
 
     return dataframe
 
 
+@traced
 def export_to_csv(df, location, filename):
     """Exports a df to a csv file.
 
@@ -70,6 +94,7 @@ def export_to_csv(df, location, filename):
     return df.to_csv(location + filename + '.csv')
 
 
+@traced
 def main():
     # Import dataframe from original xls
     df = read_data()
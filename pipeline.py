@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import glob
+import json
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from hit_cache import file_content_hash
+
+# Other global variables
+STATE_FILENAME = "input/generated/pipeline_state.json"
+# Set to the name of the stage in the environment of each script the pipeline runs, so
+# that a script can finish everything it writes (e.g. deferred charts) before it exits
+PIPELINE_STAGE_ENV = 'REF_PIPELINE_STAGE'
+
+# Code shared by more than one stage
+COMMON_CODE = ['corpus_cache.py', 'instrumentation.py']
+SEARCH_TERM_CODE = ['term_matching.py', 'lib/policy_common_data/**/*.py']
+
+
+class PipelineStage(object):
+    """One script in the pipeline, with the files it reads and writes.
+
+    Inputs and outputs are lists of filenames or glob patterns. A stage needs
+    running when the content of any of its inputs (including its own code) has
+    changed since it last ran, or when any of its outputs are missing or have
+    been changed by something else.
+    """
+
+    def __init__(self, name, command, inputs, outputs, depends_on=()):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.depends_on = list(depends_on)
+
+
+# The pipeline, in an order that respects the dependencies
+STAGES = [
+    PipelineStage('organise_studies_by_funder', ['organise_studies_by_funder.py'],
+                  ['organise_studies_by_funder.py', 'input/raw/studies_by_council/*.xlsx'] + COMMON_CODE,
+                  ['input/generated/list_of_studies_by_council.csv']),
+    PipelineStage('merge_studies_with_funder', ['merge_studies_with_funder.py'],
+                  ['merge_studies_with_funder.py', 'input/raw/CaseStudies.xlsx',
+                   'input/generated/list_of_studies_by_council.csv'] + COMMON_CODE,
+                  ['input/generated/all_ref_case_study_data.csv'],
+                  depends_on=['organise_studies_by_funder']),
+    PipelineStage('corpus_index', ['corpus_index.py'],
+                  ['corpus_index.py', 'input/generated/all_ref_case_study_data.csv'] + COMMON_CODE,
+                  ['input/generated/corpus_index.pickle'],
+                  depends_on=['merge_studies_with_funder']),
+    PipelineStage('text_store', ['text_store.py'],
+                  ['text_store.py', 'input/generated/all_ref_case_study_data.csv'] + COMMON_CODE,
+                  ['input/generated/text_store/text.bin', 'input/generated/text_store/index.pickle'],
+                  depends_on=['merge_studies_with_funder']),
+    PipelineStage('ref_case_studies', ['ref_case_studies.py'],
+                  ['ref_case_studies.py', 'corpus_index.py', 'hit_cache.py', 'count_cube.py', 'result_export.py', 'text_store.py',
+                   'charts.py', 'input/generated/all_ref_case_study_data.csv', 'input/generated/list_of_studies_by_council.csv',
+                   'input/generated/corpus_index.pickle', 'input/generated/text_store/index.pickle',
+                   'input/raw/units_of_assessment.csv'] + COMMON_CODE + SEARCH_TERM_CODE,
+                  ['outputs/only_case_studies_with_search_term_identified.*', 'outputs/summary_of_where_terms_found.csv',
+                   'outputs/summary_of_funders.csv', 'outputs/summary_of_uoas.csv', 'outputs/summary_of_panels.csv',
+                   'outputs/summary_of_word_popularity.csv', 'outputs/count_cube.pickle', 'outputs/charts/*.png'],
+                  depends_on=['merge_studies_with_funder', 'corpus_index', 'text_store']),
+    PipelineStage('sentence_finder', ['sentence_finder.py', '--batch'],
+                  ['sentence_finder.py', 'corpus_index.py', 'text_store.py', 'input/generated/all_ref_case_study_data.csv',
+                   'input/generated/text_store/index.pickle'] + COMMON_CODE + SEARCH_TERM_CODE,
+                  ['outputs/keywords_in_context.csv'],
+                  depends_on=['merge_studies_with_funder', 'text_store']),
+]
+
+
+def expand(patterns):
+    """Find the files matched by a list of filenames and glob patterns.
+
+    :params: a list of filenames or glob patterns
+    :return: a sorted list of the files that exist, and a list of the filenames that don't
+             exist and the raw data patterns that match nothing
+    """
+    found = set()
+    missing = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = glob.glob(pattern, recursive=True)
+            if not matches and pattern.startswith('input/raw/'):
+                missing.append(pattern)
+            found.update(matches)
+        elif os.path.exists(pattern):
+            found.add(pattern)
+        else:
+            missing.append(pattern)
+
+    return sorted(found), missing
+
+
+class FileHasher(object):
+    """Hashes file contents, reusing earlier hashes of files that haven't been touched.
+
+    A file whose size and modification time are the same as when it was last
+    hashed is not read again, which keeps a run where nothing has changed fast.
+    """
+
+    def __init__(self, known=None):
+        self.known = dict(known or {})
+
+    def hash(self, filename):
+        """Hash the contents of a file, unless it hasn't been touched since it was last hashed."""
+        stat = os.stat(filename)
+        fingerprint = [stat.st_size, stat.st_mtime]
+        known = self.known.get(filename)
+        if known is not None and known['fingerprint'] == fingerprint:
+            return known['hash']
+
+        content_hash = file_content_hash(filename)
+        self.known[filename] = {'fingerprint': fingerprint, 'hash': content_hash}
+
+        return content_hash
+
+    def hash_files(self, filenames):
+        """Hash a list of files, returning a dict of filename to hash."""
+        return dict((filename, self.hash(filename)) for filename in filenames)
+
+
+def load_state(filename=STATE_FILENAME):
+    """Load what the pipeline knew at the end of its last run.
+
+    :return: a dict with the hashes of each stage's inputs and outputs when it last ran, and the known file hashes
+    """
+    if not os.path.exists(filename):
+        return {'stages': {}, 'files': {}}
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_state(state, filename=STATE_FILENAME):
+    """Save what the pipeline knows, replacing the previous state in one step."""
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def stage_status(stage, state, hasher):
+    """Work out whether a stage needs running.
+
+    :params: a PipelineStage, the pipeline state and a FileHasher
+    :return: a tuple of 'run', 'skip' or 'up to date', and the reason
+    """
+    inputs, missing_inputs = expand(stage.inputs)
+    outputs, missing_outputs = expand(stage.outputs)
+
+    if missing_outputs:
+        return 'run', 'missing ' + ', '.join(missing_outputs)
+
+    # Raw data that hasn't been downloaded is fine, as long as the stage's
+    # outputs have been supplied instead
+    if any(filename.startswith('input/raw/') for filename in missing_inputs):
+        return 'skip', 'raw data not downloaded, using the supplied outputs'
+    if missing_inputs:
+        return 'run', 'missing ' + ', '.join(missing_inputs)
+
+    last_run = state['stages'].get(stage.name)
+    if last_run is None:
+        return 'run', 'never run'
+    if hasher.hash_files(inputs) != last_run['inputs']:
+        return 'run', 'inputs changed'
+    if hasher.hash_files(outputs) != last_run['outputs']:
+        return 'run', 'outputs changed'
+
+    return 'up to date', ''
+
+
+def run_stage(stage):
+    """Run the script behind a stage.
+
+    :params: a PipelineStage
+    :return: the exit code of the script
+    """
+    print('running ' + stage.name)
+
+    return subprocess.call([sys.executable] + stage.command, env=dict(os.environ, **{PIPELINE_STAGE_ENV: stage.name}))
+
+
+def run_pipeline(stages, state, hasher, max_workers=1, force=False):
+    """Run the stages that need running, in dependency order.
+
+    A stage is started once every stage it depends on has finished, so stages
+    that don't depend on each other run at the same time when max_workers is more than 1
+    :params: a list of PipelineStages, the pipeline state, a FileHasher, the number of
+             stages that can run at once, and whether to run every stage regardless
+    :return: True if every stage that ran succeeded
+    """
+    pending = list(stages)
+    done = set()
+    failed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start every stage whose dependencies have all finished
+            for stage in list(pending):
+                if any(dependency in failed for dependency in stage.depends_on):
+                    pending.remove(stage)
+                    failed.add(stage.name)
+                    print('skipping ' + stage.name + ': a stage it depends on failed')
+                elif all(dependency in done for dependency in stage.depends_on):
+                    pending.remove(stage)
+                    status, reason = stage_status(stage, state, hasher)
+                    if force:
+                        status, reason = 'run', 'forced'
+                    if status == 'run':
+                        print(stage.name + ': ' + reason)
+                        running[stage.name] = (stage, executor.submit(run_stage, stage))
+                    else:
+                        done.add(stage.name)
+
+            if not running:
+                continue
+
+            # Wait for any of the running stages to finish
+            finished, _ = wait([future for _, future in running.values()], return_when=FIRST_COMPLETED)
+            for name, (stage, future) in list(running.items()):
+                if future not in finished:
+                    continue
+                del running[name]
+                if future.result() != 0:
+                    print(stage.name + ' failed')
+                    failed.add(stage.name)
+                    continue
+
+                # Record what the stage read and wrote, so it isn't run again until they change
+                inputs, _ = expand(stage.inputs)
+                outputs, _ = expand(stage.outputs)
+                state['stages'][stage.name] = {'inputs': hasher.hash_files(inputs), 'outputs': hasher.hash_files(outputs)}
+                done.add(stage.name)
+
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the stages of the analysis whose inputs have changed.')
+    parser.add_argument('stages', nargs='*', help='only run these stages (and check the ones they depend on)')
+    parser.add_argument('--jobs', type=int, default=1, help='how many independent stages can run at once')
+    parser.add_argument('--force', action='store_true', help='run every stage, whether or not it is up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only say which stages would run')
+    args = parser.parse_args()
+
+    stages = STAGES
+    if args.stages:
+        wanted = set(args.stages)
+        for stage in reversed(STAGES):
+            if stage.name in wanted:
+                wanted.update(stage.depends_on)
+        stages = [stage for stage in STAGES if stage.name in wanted]
+
+    state = load_state()
+    hasher = FileHasher(state['files'])
+
+    if args.dry_run:
+        will_run = set()
+        for stage in stages:
+            status, reason = stage_status(stage, state, hasher)
+            if status != 'run' and will_run.intersection(stage.depends_on):
+                status, reason = 'run', 'a stage it depends on will run'
+            if status == 'run':
+                will_run.add(stage.name)
+            print(stage.name + ': ' + status + (' (' + reason + ')' if reason else ''))
+        return
+
+    succeeded = run_pipeline(stages, state, hasher, args.jobs, args.force)
+
+    state['files'] = hasher.known
+    save_state(state)
+
+    if not succeeded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
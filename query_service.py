@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+
+from corpus_cache import file_fingerprint
+from corpus_loader import DATAFILENAME, QueryError, load_corpus
+
+# Other global variables
+# The service only listens on this machine
+HOST = '127.0.0.1'
+PORT = 8014
+# How many seconds to wait between checks of whether the case study data has changed
+RELOAD_INTERVAL = 5
+# Requests with headers longer than this are refused
+MAX_REQUEST_BYTES = 64 * 1024
+
+
+class QueryService(object):
+    """Answers queries over the case studies through a small HTTP interface.
+
+    Queries are answered from a LoadedCorpus held in memory, in a pool of
+    threads so that a slow query doesn't hold up the others. The case study
+    file is checked every RELOAD_INTERVAL seconds, and when it has changed the
+    corpus is reloaded in a separate thread. Queries carry on being answered
+    from the old corpus while the new one loads, and the new one replaces it
+    in a single step once it is ready.
+    """
+
+    def __init__(self, filename=DATAFILENAME, reload_interval=RELOAD_INTERVAL):
+        self.filename = filename
+        self.reload_interval = reload_interval
+        self.corpus = load_corpus(filename)
+
+    def answer(self, path, query):
+        """Answer a query.
+
+        :params: the path of the request and a dict of query parameter to list of values
+        :return: a tuple of the HTTP status and a dict to send back as JSON
+        """
+        try:
+            if path == '/count':
+                return 200, self.corpus.count(query)
+            if path == '/snippets':
+                return 200, self.corpus.snippets(query)
+            if path == '/status':
+                return 200, self.corpus.describe()
+        except QueryError as error:
+            return 400, {'error': str(error)}
+        except Exception as error:
+            # Keep serving other queries, and tell the client this one failed rather than dropping the connection
+            print('query failed: ' + repr(error))
+            return 500, {'error': 'The query could not be answered: ' + repr(error)}
+
+        return 404, {'error': 'Unknown path: ' + path + '. Use /count, /snippets or /status'}
+
+    async def handle(self, reader, writer):
+        """Read one HTTP request from a client and send the answer back."""
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        request_line = request.split(b'\r\n', 1)[0].decode('latin-1').split()
+        if len(request_line) != 3 or request_line[0] != 'GET':
+            status, body = 405, {'error': 'Only GET requests are answered'}
+        else:
+            # Answering a query is CPU bound, so it's done in the same pool of threads as the
+            # reloads, leaving the event loop free to accept other requests meanwhile
+            url = urlsplit(request_line[1])
+            status, body = await asyncio.get_event_loop().run_in_executor(None, self.answer, url.path, parse_qs(url.query))
+
+        content = json.dumps(body).encode('utf-8')
+        writer.write(('HTTP/1.1 ' + str(status) + ' ' + {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                                                         405: 'Method Not Allowed', 500: 'Internal Server Error'}[status] + '\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: ' + str(len(content)) + '\r\n'
+                      'Connection: close\r\n\r\n').encode('latin-1') + content)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def watch(self):
+        """Reload the corpus whenever the case study file changes."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if file_fingerprint(self.filename) == self.corpus.fingerprint:
+                    continue
+                print('case study data has changed, reloading')
+                self.corpus = await loop.run_in_executor(None, load_corpus, self.filename)
+                print('reloaded ' + str(len(self.corpus.df)) + ' case studies')
+            except Exception as error:
+                # The file may be half written, so keep answering from the old corpus and try again later
+                print('reload failed, will retry: ' + repr(error))
+
+    def serve(self, host=HOST, port=PORT):
+        """Answer queries until interrupted."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST_BYTES))
+        watcher = loop.create_task(self.watch())
+        print('answering queries on http://' + host + ':' + str(port) + ' (Ctrl-C to stop)')
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.cancel()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Answer count and snippet queries over the case studies from memory.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL,
+                        help='seconds between checks of whether the case study data has changed')
+    args = parser.parse_args()
+
+    QueryService(DATAFILENAME, args.reload_interval).serve(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import pandas as pd
-from pandas import ExcelWriter
 import numpy as np
+import pandas as pd
+
+from count_cube import SAMPLING_WEIGHT
 
 # Other global variables
-DATAFILENAME = "./data/all_ref_case_study_data.csv"
-RESULT_STORE = "./data/"
+DATAFILENAME = "input/generated/all_ref_case_study_data.csv"
+RESULT_STORE = "input/generated/"
 FRACTION_TO_REDUCE = 0.9
+# The same seed always gives the same sample of the same data
+SEED = 0
+# How many rows of the full data set are read at a time
+CHUNK_SIZE = 1000
+
 
 def import_csv_to_df(filename):
     """
@@ -16,7 +22,7 @@ def import_csv_to_df(filename):
     :params: a csv file
     :return: a df
     """
-    
+
     return pd.read_csv(filename)
 
 
@@ -30,16 +36,146 @@ def export_to_csv(df, location, filename):
     return df.to_csv(location + filename + '.csv')
 
 
+def uoa_keys(df):
+    """Find the Unit of Assessment of each case study, in the form used to group them.
+
+    :return: a series of lowercased UoA names with runs of whitespace collapsed
+    """
+    return df['Unit of Assessment'].map(lambda name: ' '.join(str(name).lower().split()))
+
+
+class StratifiedSampler(object):
+    """Samples a fraction of the case studies in each Unit of Assessment and combination of funders.
+
+    The case studies are offered a chunk at a time, in a single pass. Within
+    each stratum (a UoA and the set of funders linked to a case study) every
+    1/fraction-th case study is kept, starting from a random offset, so each
+    stratum keeps the same fraction of its case studies give or take one.
+    One case study of each UoA and of each funder is also held back at random,
+    and added to the sample at the end if its UoA or funder would otherwise be
+    missing from it.
+
+    Every case study has the same chance (the fraction) of being picked by the
+    systematic selection, so each pick stands for 1/fraction case studies. These
+    weights are then scaled within each UoA so that they add up to the number of
+    case studies in that UoA, less one for each held back case study added to it,
+    which stands only for itself. A UoA with no picks at all is stood for by its
+    held back case studies alone. The weights of the sample therefore add up to
+    the number of case studies in the full data set, and weighted counts of the
+    sample estimate counts of the full data set.
+    """
+
+    def __init__(self, fraction, seed=SEED):
+        self.fraction = fraction
+        self.rng = np.random.RandomState(seed)
+        self.funder_cols = None
+        self.stratum_sizes = {}
+        self.stratum_offsets = {}
+        self.sampled = []
+        # The case study held back for each UoA and funder, and the number of case studies seen of each
+        self.held_back = {}
+        self.seen = {}
+
+    def strata(self, df):
+        """Find the stratum of each case study.
+
+        :return: a series of strings naming the UoA and funders of each case study
+        """
+        funders = df[self.funder_cols].fillna(False).astype(bool).values
+        funder_sets = [','.join(np.asarray(self.funder_cols)[row]) for row in funders]
+
+        return uoa_keys(df) + '|' + pd.Series(funder_sets, index=df.index)
+
+    def hold_back(self, df, keys):
+        """Hold back a random case study for each key, by reservoir sampling.
+
+        :params: a chunk of case studies and a series of the key of each (e.g. its UoA)
+        :return: nothing
+        """
+        position = keys.groupby(keys).cumcount() + 1 + keys.map(lambda key: self.seen.get(key, 0))
+        replace = self.rng.rand(len(df)) * position.values < 1
+        for key, rows in df[replace].groupby(keys[replace]):
+            self.held_back[key] = rows.iloc[[-1]]
+        for key, count in keys.value_counts().items():
+            self.seen[key] = self.seen.get(key, 0) + count
+
+    def offer(self, df):
+        """Sample from a chunk of the case studies.
+
+        :params: a chunk of case studies, with an index giving the position of each in the full data set
+        :return: nothing
+        """
+        if self.funder_cols is None:
+            self.funder_cols = [col for col in df.columns if 'funder' in col]
+
+        strata = self.strata(df)
+        for stratum in strata.unique():
+            if stratum not in self.stratum_offsets:
+                self.stratum_offsets[stratum] = self.rng.rand()
+
+        # Number the case studies of each stratum, across all the chunks so far
+        position = (strata.groupby(strata).cumcount() + strata.map(lambda stratum: self.stratum_sizes.get(stratum, 0))).values
+        offset = strata.map(self.stratum_offsets).values
+        keep = np.floor((position + 1) * self.fraction + offset) > np.floor(position * self.fraction + offset)
+        self.sampled.append(df[keep])
+
+        for stratum, count in strata.value_counts().items():
+            self.stratum_sizes[stratum] = self.stratum_sizes.get(stratum, 0) + count
+
+        self.hold_back(df, 'uoa:' + uoa_keys(df))
+        funders = df[self.funder_cols].fillna(False).astype(bool)
+        for col in self.funder_cols:
+            self.hold_back(df[funders[col]], pd.Series('funder:' + col, index=df.index[funders[col]]))
+
+    def sample(self):
+        """Finish the sample.
+
+        :return: a dataframe of the sampled case studies in their original order,
+                 with a sampling weight col
+        """
+        picked = pd.concat(self.sampled)
+
+        # Add the held back case study of any UoA or funder that isn't in the sample
+        present = set('uoa:' + uoa_keys(picked))
+        if len(picked):
+            funders = picked[self.funder_cols].fillna(False).astype(bool)
+            present.update('funder:' + col for col in self.funder_cols if funders[col].any())
+        missing = [self.held_back[key] for key in sorted(self.held_back) if key not in present]
+        sample = pd.concat([picked] + missing)
+        sample = sample[~sample.index.duplicated()].sort_index()
+        is_picked = sample.index.isin(picked.index)
+
+        # The number of case studies of each UoA in the full data set, and the
+        # number of picked and held back case studies of it in the sample
+        uoa_sizes = pd.Series(self.stratum_sizes)
+        uoa_sizes = uoa_sizes.groupby(uoa_sizes.index.map(lambda stratum: stratum.split('|')[0])).sum()
+        uoas = uoa_keys(sample)
+        picked_counts = uoas[is_picked].value_counts().reindex(uoa_sizes.index, fill_value=0)
+        held_back_counts = uoas[~is_picked].value_counts().reindex(uoa_sizes.index, fill_value=0)
+
+        picked_weights = (uoa_sizes - held_back_counts) / picked_counts
+        held_back_weights = (uoa_sizes / held_back_counts).where(picked_counts == 0, 1)
+        sample[SAMPLING_WEIGHT] = np.where(is_picked, uoas.map(picked_weights), uoas.map(held_back_weights))
+
+        total = sum(self.stratum_sizes.values())
+        if not np.isclose(sample[SAMPLING_WEIGHT].sum(), total):
+            raise ValueError('The sampling weights add up to ' + str(sample[SAMPLING_WEIGHT].sum()) +
+                             ' rather than the ' + str(total) + ' case studies sampled from')
+
+        return sample
+
+
 def main():
-    
-    # Read in the data
-    df = import_csv_to_df(DATAFILENAME)
-    
-    # Knock out a fraction (denoted by 'frac') of the rows of the dataframe
-    df2 = df.drop(df.sample(frac=FRACTION_TO_REDUCE, axis=0).index)
+
+    # Read in the data a chunk at a time, keeping a stratified sample of
+    # the rows that leaves out a fraction (FRACTION_TO_REDUCE) of them
+    sampler = StratifiedSampler(1 - FRACTION_TO_REDUCE, SEED)
+    for df in pd.read_csv(DATAFILENAME, chunksize=CHUNK_SIZE):
+        sampler.offer(df)
+    df2 = sampler.sample()
 
     # Save the data
     export_to_csv(df2, RESULT_STORE, 'test_data_only')
-    
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
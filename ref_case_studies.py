@@ -3,16 +3,29 @@
 
 import os
 import sys
+import json
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 # Add search terms from policy_common_data submodule repo
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "lib", "policy_common_data"))
 from commondata.softwaresearchterms import SoftwareSearchTerms
 
+from term_matching import TermMatcher
+from corpus_index import INDEX_FILENAME, load_index
+from corpus_cache import read_cached_csv
+from text_store import load_text_store
+from hit_cache import corpus_hash_for, load_hit_cache, save_hit_cache
+from count_cube import ANY_TERM, ANYWHERE, ALL, ALL_STUDIES, SAMPLING_WEIGHT, build_count_cube, save_count_cube, is_matching_words
+from result_export import TableWriter, export_table, export_tables
+from instrumentation import traced
+
 # Other global variables
-# This is test data set made by randomly deleting 90% of the rows of the real data set. Use it instead of the
-# real data set to make life faster when prototyping
+# This is test data set made by reduce_df_for_test.py, a stratified sample of 10% of the rows of the real data set.
+# Use it instead of the real data set to make life faster when prototyping. Its sampling weights scale the
+# summaries up to estimates for the real data set
 #DATAFILENAME = "input/generated/test_data_only.csv"
 # The real data set of all case studies, which should be used when wishing to generate actual results
 DATAFILENAME = "input/generated/all_ref_case_study_data.csv"
@@ -20,61 +33,246 @@ STUDIES_BY_FUNDER = "input/generated/list_of_studies_by_council.csv"
 UNITS_OF_ASSESSMENT = "input/raw/units_of_assessment.csv"
 RESULT_STORE = "outputs/"
 CHART_RESULT_STORE = "outputs/charts/"
+# How the charts are drawn once the CSV files are written: 'sync' draws them before
+# main returns, 'deferred' hands them to a background process so main returns as soon
+# as the CSV files are written, and 'none' doesn't draw them (or import matplotlib) at all
+CHART_MODE = 'sync'
+# Set by pipeline.py when it runs this script. The pipeline records the charts as outputs
+# once the script exits, so deferred charts are waited for rather than left drawing
+PIPELINE_STAGE_ENV = 'REF_PIPELINE_STAGE'
+# Set this to a number of rows to read the case studies in chunks of that many rows
+# rather than all at once, so that peak memory depends on the chunk size rather than
+# on the size of the data set. The results are the same either way
+CHUNK_SIZE = None
+# Set this to more than 1 to split the case studies into shards and search them
+# for the terms in that many processes at once. The results are the same either way
+MATCHING_PROCESSES = 1
+# How many shards each matching process gets, so that a slow shard doesn't hold the others up
+SHARDS_PER_PROCESS = 4
+# The export of the case studies with search terms identified only has their ids, UoAs, funders and where
+# each term was found. Set this to True to include every col of the case study data, including the full text
+EXPORT_FULL_TEXT = False
+# The format of the export of the case studies with search terms identified: 'csv', 'csv.gz' or 'parquet'
+CASE_STUDY_EXPORT_FORMAT = 'csv'
+CASE_STUDY_EXPORT = 'only_case_studies_with_search_term_identified'
+
+
+@traced
+def import_csv_to_df(filename, columns=None):
+    """
+    Imports a csv file into a Pandas dataframe, through the columnar cache in corpus_cache.py
+    :params: a csv file and optionally a list of the columns to load
+    :return: a df
+    """
+    return read_cached_csv(filename, columns)
+
 
+def case_study_export_cols(df):
+    """Find the cols of the case study data to include in the export of the case studies with search terms identified.
 
-def import_csv_to_df(filename):
+    :params: a dataframe of case studies
+    :return: every col if EXPORT_FULL_TEXT is set, otherwise the id, UoA and funder cols
     """
-    Imports a csv file into a Pandas dataframe
-    :params: a csv file
-    :return: a df
+    if EXPORT_FULL_TEXT:
+        return list(df.columns)
+
+    return ['Case Study Id', 'Unit of Assessment'] + get_col_list(df, 'funder')
+
+
+@traced
+def find_terms_in_places(dataframe, matcher, search_places, processes=1, text_store=None):
+    """Find every search term in every search place with a single scan per place.
+
+    Each of the columns in search_places is scanned once by the matcher, rather
+    than once for every search term, and the hits are recorded in a boolean
+    matrix rather than as new columns on the case study dataframe
+    :params: a dataframe, a TermMatcher holding the search terms, a list of column
+             names relating to parts in a case study in which the terms should be searched for,
+             optionally a number of processes to split the case studies across, and optionally
+             a TextStore to read the text from (the dataframe then only needs the Case Study Id)
+    :return: a boolean dataframe indexed by Case Study Id, with a (term, place) column
+             for each term and place that is True where the term was found in that place
     """
-    return pd.read_csv(filename)
+    if processes > 1 and len(dataframe) > processes:
+        return find_terms_in_places_in_parallel(dataframe, matcher, search_places, processes, text_store)
+
+    term_index = {term: i for i, term in enumerate(matcher.terms)}
+    matrix = np.zeros((len(dataframe), len(matcher.terms), len(search_places)), dtype=bool)
+    if text_store is not None:
+        rows = text_store.rows_for(dataframe['Case Study Id'])
+
+    for place_index, part_in_bid in enumerate(search_places):
+        if text_store is None:
+            found = matcher.find_terms_in_column(dataframe[part_in_bid])
+        else:
+            found = map(matcher.find_terms, text_store.texts(part_in_bid, rows))
+        for row, terms in enumerate(found):
+            for term in terms:
+                matrix[row, term_index[term], place_index] = True
 
+    columns = pd.MultiIndex.from_product([matcher.terms, search_places], names=['term', 'place'])
+    index = pd.Index(dataframe['Case Study Id'], name='Case Study Id')
 
-def export_to_csv(df, location, filename):
+    return pd.DataFrame(matrix.reshape(len(dataframe), -1), index=index, columns=columns)
+
+
+def find_terms_in_places_in_parallel(dataframe, matcher, search_places, processes, text_store=None):
+    """Find every search term in every search place, with the case studies split across processes.
+
+    The case studies are split into shards of consecutive rows, each shard is
+    searched by find_terms_in_places in a pool of processes, and the hit
+    matrices are joined back together in their original order
+    :params: as find_terms_in_places, plus the number of processes to use
+    :return: a boolean dataframe in the same layout as find_terms_in_places
     """
-    Exports a df to a csv file
-    :params: a df and a location in which to save it
-    :return: nothing, saves a csv
+    # Only the columns that are searched are sent to the processes. With a text
+    # store, only the ids are sent and each process maps the same text file
+    dataframe = dataframe[['Case Study Id'] + (list(search_places) if text_store is None else [])]
+
+    shard_size = -(-len(dataframe) // (processes * SHARDS_PER_PROCESS))
+    shards = [dataframe.iloc[start:start + shard_size] for start in range(0, len(dataframe), shard_size)]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        shard_hits = list(executor.map(find_terms_in_places, shards, [matcher] * len(shards), [search_places] * len(shards),
+                                       [1] * len(shards), [text_store] * len(shards)))
+
+    return pd.concat(shard_hits)
+
+
+@traced
+def find_terms_in_places_from_index(dataframe, index, matcher, search_places, text_store=None):
+    """Find every search term in every search place by looking them up in an inverted index.
+
+    Terms are looked up in the index rather than scanned for, so adding a new
+    search term costs a lookup rather than a pass over the whole corpus. Any terms
+    that the index cannot answer are scanned for with a matcher holding just those terms
+    :params: a dataframe, a CorpusIndex built from it, a TermMatcher holding the search terms,
+             a list of column names relating to parts in a case study in which the terms should be searched for,
+             and optionally a TextStore to read the text from
+    :return: a boolean dataframe in the same layout as find_terms_in_places
     """
-    return df.to_csv(location + filename + '.csv')
+    row_index = {study_id: row for row, study_id in enumerate(dataframe['Case Study Id'])}
+    term_index = {term: i for i, term in enumerate(matcher.terms)}
+    place_index = {place: i for i, place in enumerate(search_places)}
+    matrix = np.zeros((len(dataframe), len(matcher.terms), len(search_places)), dtype=bool)
+
+    scanned_terms = []
+    for term in matcher.terms:
+        if not index.can_look_up(term):
+            scanned_terms.append(term)
+            continue
+        for study_id, place in index.find_term(term):
+            if study_id in row_index and place in place_index:
+                matrix[row_index[study_id], term_index[term], place_index[place]] = True
+
+    columns = pd.MultiIndex.from_product([matcher.terms, search_places], names=['term', 'place'])
+    study_ids = pd.Index(dataframe['Case Study Id'], name='Case Study Id')
+    hits = pd.DataFrame(matrix.reshape(len(dataframe), -1), index=study_ids, columns=columns)
+
+    if scanned_terms:
+        scanned_hits = find_terms_in_places(dataframe, TermMatcher(scanned_terms), search_places, MATCHING_PROCESSES, text_store)
+        hits[scanned_hits.columns] = scanned_hits
+
+    return hits
+
+
+@traced
+def find_terms_in_places_cached(dataframe, hit_cache, matcher, search_places, index=None, text_store=None):
+    """Find every search term in every search place, only searching for terms missing from a hit cache.
+
+    The terms that the cache has not seen are found with the inverted index if
+    there is one, or by scanning for them if not, and are added to the cache
+    :params: a dataframe, the HitCache for it, a TermMatcher holding the search terms,
+             a list of column names relating to parts in a case study in which the terms
+             should be searched for, and optionally a CorpusIndex built from the dataframe and
+             a TextStore to read the text from
+    :return: a boolean dataframe in the same layout as find_terms_in_places
+    """
+    missing_terms = hit_cache.missing_terms(matcher.terms, search_places)
+    if missing_terms:
+        missing_matcher = TermMatcher(missing_terms)
+        if index is not None:
+            new_hits = find_terms_in_places_from_index(dataframe, index, missing_matcher, search_places, text_store)
+        else:
+            new_hits = find_terms_in_places(dataframe, missing_matcher, search_places, MATCHING_PROCESSES, text_store)
+        for term, place in new_hits.columns:
+            hit_cache.put(term, place, new_hits[(term, place)].values)
+
+    matrix = np.column_stack([hit_cache.get(term, place) for term in matcher.terms for place in search_places])
 
+    columns = pd.MultiIndex.from_product([matcher.terms, search_places], names=['term', 'place'])
+    study_ids = pd.Index(dataframe['Case Study Id'], name='Case Study Id')
 
-def cut_to_specific_word(dataframe, specific_word, part_in_bid):
+    return pd.DataFrame(matrix, index=study_ids, columns=columns)
+
+
+def load_index_for_missing_terms(hit_cache, matcher, search_places, datafilename):
+    """Load the inverted index, but only if the hit cache can't answer every search term.
+
+    :params: a HitCache, a TermMatcher holding the search terms, a list of search places
+             and the csv file of case studies
+    :return: a CorpusIndex, or None if every term is in the hit cache or there is no up to date
+             index of every search place
     """
-    Takes in a dataframe and a column, and then creates a new dataframe containing only
-    the rows from the original dataframe that had the search word in that column
-    :params: a dataframe, a specific_word to look for, and a column name relating to
-             a part in a case study in which the specific_word should be searched for
-    :return: a dataframe containing only the case studies which had specific word in
-             the column of interest
+    if not hit_cache.missing_terms(matcher.terms, search_places):
+        return None
+
+    index = load_index(INDEX_FILENAME, datafilename)
+    if index is not None and not set(search_places) <= set(index.places):
+        return None
+
+    return index
+
+
+def hits_to_array(hits):
+    """View the hit matrix as a 3D array.
+
+    :params: a hit matrix from find_terms_in_places
+    :return: a tuple of the search terms, the search places and a boolean array
+             indexed by [study, term, place]
     """
-    # Cut dataframe down to only those rows with a word in the right column
-    current_df = dataframe[dataframe[part_in_bid].str.contains(r'\b' + specific_word + r'\b', regex=True, na=False)]
-    # Suppress the annoyingly pedantic SettingWithCopyWarning,
-    # since we know explicitly we're dealing with a copy
-    current_df.is_copy = False
-    # Add a new col to indicate where the specific word was found
-    new_col_name = specific_word + '_found_in_' + part_in_bid
-    current_df[new_col_name] = part_in_bid
-    # Drop all columns except the case study and the col showing where the word was found
-    current_df = current_df[['Case Study Id', new_col_name]]
+    terms = list(dict.fromkeys(hits.columns.get_level_values('term')))
+    places = list(dict.fromkeys(hits.columns.get_level_values('place')))
 
-    return current_df
+    # The hit matrix always has a column for every term and place, term by term,
+    # but make sure of that before reshaping
+    columns = pd.MultiIndex.from_product([terms, places], names=['term', 'place'])
+    if not hits.columns.equals(columns):
+        hits = hits[columns]
 
+    return terms, places, hits.values.reshape(len(hits), len(terms), len(places))
 
-def associate_new_data(dataframe, df_studies_by_funder):
-    """Merge two dataframes based on Case Study ID.
 
-    Takes a dataframe with the case study information and merges it with another
-    dataframe that contains case study IDs and some other data (e.g. funders, disciplines)
+def flag_to_categorical(flags, label):
+    """Turn a boolean series into a categorical holding a label where it is True.
 
-    :params: a dataframe with case study information, a second dataframe with cases study IDs and other information
-    :return: a dataframe containing case study information and other merged information
+    :params: a boolean series and the label to use where it is True
+    :return: a categorical series holding the label where flags is True and NaN elsewhere
     """
-    dataframe = pd.merge(left=dataframe, right=df_studies_by_funder, how='left', left_on='Case Study Id', right_on='Case Study Id')
+    codes = np.where(flags.values, 0, -1).astype(np.int8)
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories=[label]), index=flags.index)
 
-    return dataframe
+
+def hits_to_found_in_cols(hits):
+    """Expand the hit matrix into the wide columns used in exported csv files.
+
+    This is only needed at export time, so that the csv files keep their
+    familiar layout of one string column per term and place. The columns are
+    categoricals, so each holds a small integer code per case study rather than
+    a repeated string, but they are written to csv exactly as strings would be
+    :params: a hit matrix from find_terms_in_places
+    :return: a dataframe indexed by Case Study Id, with a <term>_found_in_<place> column for
+             each term and place holding the place if the term was found there or NaN
+             if not, an any_term_found_in_anywhere column and a search terms found count
+    """
+    found_in_cols = {}
+    for term, place in hits.columns:
+        found_in_cols[term + '_found_in_' + place] = flag_to_categorical(hits[(term, place)], place)
+    found_in_cols['any_term_found_in_anywhere'] = flag_to_categorical(hits.any(axis=1), 'anywhere')
+    found_in_cols['search terms found'] = hits.sum(axis=1)
+
+    return pd.DataFrame(found_in_cols, index=hits.index)
 
 
 def get_col_list(df, search_string):
@@ -91,51 +289,60 @@ def get_col_list(df, search_string):
     return list_cols
 
 
-def summarise_search_terms(df, search_terms, search_places, cols_list, all_case_study_count):
-    """Summarise the results across all words searched for.
+@traced
+def summarise_search_terms_from_counts(counts, search_terms, search_places, all_case_study_count):
+    """Summarise the results across all words searched for from counts taken from a count cube.
 
     :returns: a dataframe with the summary results
     """
-    summary_data = {}
-
-    # Go through the parts in the study and for each one create a list of
-    # associated columns, then drop any rows where all the columns are NaN
-    # then take the length of the resulting df (which represents how many
-    # times the any of the words were found in that part of the study)
-    for curr_place in search_places:
-        # Get list of cols that match the curr_place
-        matching = [s for s in cols_list if curr_place in s]
-        # Drop all rows where NaN across the "matching" list
-        temp_df = df.dropna(subset=[matching], how='all', axis=0)
-        summary_data[curr_place] = len(temp_df)
-
-    summary_df = pd.DataFrame(list(summary_data.items()), columns=['word location', 'count matching 1 word'])
+    # Make sure there's a row for every number of words looked at below
+    counts = counts.reindex(range(max(len(counts), len(search_terms)+1)), fill_value=0)
+
+    # The count in each place represents how many times any of the words
+    # were found in that part of the study
+    summary_data = counts[search_places].sum()
+
+    summary_df = pd.DataFrame({'word location': summary_data.index, 'count matching 1 word': summary_data.values})
     summary_df['% of all studies'] = round(100 * (summary_df['count matching 1 word']/all_case_study_count), 0)
     summary_df.sort_values(['count matching 1 word'], ascending=False, inplace=True)
 
     # Now that we've sorted the count for a single word found in the df
-    # see how many words have multiple matches
-    for i in range(2, len(search_terms)+1):
-        shortened_df = df[df['search terms found'] == i]
-        count_plus_i_word = {}
-        for curr_place in search_places:
-            matching = [s for s in cols_list if curr_place in s]
-            temp_df = shortened_df.dropna(subset=[matching], how='all', axis=0)
-            count_plus_i_word[curr_place] = len(temp_df)
-        summary_df['count matching ' + str(i) + ' words'] = summary_df['word location'].map(count_plus_i_word)
-        summary_df['% all studies ' + str(i) + ' words'] = round(100 * (summary_df['count matching ' + str(i) + ' words']/all_case_study_count), 0)
+    # see how many words have multiple matches. All the multiple match columns
+    # are worked out as one block, in the sorted order of the places
+    multiple_counts = counts.loc[2:len(search_terms), search_places].T.reindex(summary_df['word location'])
+    multiple_pcts = (100 * (multiple_counts/all_case_study_count)).round(0)
+
+    multiple_cols = {}
+    multiple_col_order = []
+    for i in multiple_counts.columns:
+        multiple_cols['count matching ' + str(i) + ' words'] = multiple_counts[i].values
+        multiple_cols['% all studies ' + str(i) + ' words'] = multiple_pcts[i].values
+        multiple_col_order += ['count matching ' + str(i) + ' words', '% all studies ' + str(i) + ' words']
 
     summary_df.set_index('word location', inplace=True)
+    summary_df = pd.concat([summary_df, pd.DataFrame(multiple_cols, index=summary_df.index, columns=multiple_col_order)], axis=1)
 
     return summary_df
 
 
-def summarise_funders(df, cols_to_search, all_case_study_count):
-    """Create a summary df of the funders found in the data."""
+def compact_funder_cols(df, funder_cols):
+    """Store the funder cols as booleans.
+
+    Funder cols read from a csv file written before the funders were stored as
+    booleans hold True or NaN, which pandas keeps as Python objects. As booleans
+    they take a byte per case study
+    :params: a dataframe and a list of its funder cols
+    :return: the dataframe, with every funder col as a boolean col
+    """
+    if funder_cols:
+        df[funder_cols] = df[funder_cols].fillna(False).astype(bool)
+
+    return df
 
-    # Create temp df containing only the cols to be searched and use count() to create a summary series
-    temp_df = df[cols_to_search]
-    count_series = temp_df.count()
+
+@traced
+def summarise_funders_from_counts(count_series, all_case_study_count):
+    """Create a summary df of the funders found in the data from counts taken from a count cube."""
 
     # Convert summary series into df
     summary_df = pd.DataFrame({'index': count_series.index, 'count': count_series.values})
@@ -151,24 +358,44 @@ def summarise_funders(df, cols_to_search, all_case_study_count):
     return summary_df
 
 
-def summarise_uoas(df, df_term_found, list_of_uoas, all_case_study_count):
-    """Create a summary df of the number of Units of Assessment found in the data."""
+def normalise_uoa_name(name):
+    """Put the name of a Unit of Assessment into the form used to match it.
+
+    :params: a UoA name
+    :return: the name lowercased, stripped and with runs of whitespace collapsed to a single space
+    """
+    return ' '.join(str(name).lower().split())
 
-    uoa_term_found_dict = {}
-    uoa_all_dict = {}
 
-    for current_uoa in list_of_uoas:
-        # Cut to only one uoa in the df limited to rows with the search terms found
-        temp_df = df_term_found[df_term_found['Unit of Assessment'].str.contains(current_uoa)]
-        # Cut to only one uoa in the df with all case studies
-        temp_2_df = df[df['Unit of Assessment'].str.contains(current_uoa)]
-        uoa_term_found_dict[current_uoa] = len(temp_df)
-        uoa_all_dict[current_uoa] = len(temp_2_df)
+def get_uoa_ids(uoa_col, list_of_uoas):
+    """Normalise the Unit of Assessment col into one of the known Units of Assessment.
 
-    # Create a df from the dict
-    summary_df = pd.DataFrame(list(uoa_term_found_dict.items()), columns=['unit of assessment', 'software reliant count'])
-    # Add a column to the summary from the uoa_all_dict
-    summary_df['all studies count'] = summary_df['unit of assessment'].map(uoa_all_dict)
+    Each distinct value in the col is matched once, rather than each UoA being
+    searched for in every row. A value that isn't exactly a known UoA is matched
+    to the longest known UoA contained in it
+    :params: the 'Unit of Assessment' col and a list of normalised UoA names
+    :return: a categorical with the list of UoAs as its categories, and NaN where no UoA matched
+    """
+    uoa_mapping = {}
+    for value in uoa_col.dropna().unique():
+        name = normalise_uoa_name(value)
+        if name in list_of_uoas:
+            uoa_mapping[value] = name
+        else:
+            containing = [current_uoa for current_uoa in list_of_uoas if current_uoa in name]
+            uoa_mapping[value] = max(containing, key=len) if containing else np.nan
+
+    return pd.Categorical(uoa_col.map(uoa_mapping), categories=list_of_uoas)
+
+
+@traced
+def summarise_uoas_from_counts(uoa_term_found_counts, uoa_all_counts, all_case_study_count):
+    """Create a summary df of the number of Units of Assessment found in the data from counts taken from a count cube."""
+
+    # Create a df from the counts
+    summary_df = pd.DataFrame({'unit of assessment': uoa_term_found_counts.index, 'software reliant count': uoa_term_found_counts.values})
+    # Add a column with the counts across all case studies
+    summary_df['all studies count'] = summary_df['unit of assessment'].map(uoa_all_counts)
     summary_df.set_index('unit of assessment', inplace=True)
 
     summary_df['percentage of studies in this uoa'] = round(100 * (summary_df['software reliant count']/summary_df['all studies count']), 0)
@@ -178,22 +405,29 @@ def summarise_uoas(df, df_term_found, list_of_uoas, all_case_study_count):
     return summary_df
 
 
-def summarise_word_popularity(df, search_terms, all_case_study_count):
-    """Create a summary df of the count of search terms found in the data."""
+@traced
+def summarise_panels(df_summary_uoas, uoa_panels, all_case_study_count):
+    """Roll a summary df of the Units of Assessment up into their Main panels.
+
+    :params: a summary df from summarise_uoas_from_counts, a dict of each UoA's main panel and the number of case studies
+    :return: a summary df of the number of studies in each main panel
+    """
+    panels = df_summary_uoas.index.map(lambda x: uoa_panels[x])
+    summary_df = df_summary_uoas[['software reliant count', 'all studies count']].groupby(panels).sum()
+    summary_df.index.name = 'main panel'
+
+    summary_df['percentage of studies in this panel'] = round(100 * (summary_df['software reliant count']/summary_df['all studies count']), 0)
+    summary_df['percentage of all studies'] = round(100 * (summary_df['software reliant count']/all_case_study_count), 0)
+    summary_df.sort_values(['software reliant count'], ascending=False, inplace=True)
 
-    # Get a list of all the found_in columns
-    matching = [s for s in df.columns if 'found_in' in s]
-    # Remove the any_term part, because it's a summary that we don't need
-    matching.remove('any_term_found_in_anywhere')
+    return summary_df
 
-    matches_to_search_term = {}
 
-    for curr_term in search_terms:
-        curr_term_match = [s for s in matching if curr_term in s]
-        temp_df = df.dropna(subset=[curr_term_match], how='all', axis=0)
-        matches_to_search_term[curr_term] = len(temp_df)
+@traced
+def summarise_word_popularity_from_counts(count_series, all_case_study_count):
+    """Create a summary df of the count of search terms found in the data from counts taken from a count cube."""
 
-    summary_df = pd.DataFrame(list(matches_to_search_term.items()), columns=['search term', 'count'])
+    summary_df = pd.DataFrame({'search term': count_series.index, 'count': count_series.values})
     summary_df['% of all studies'] = round(100 * (summary_df['count']/all_case_study_count), 0)
     summary_df.sort_values(['count'], ascending=False, inplace=True)
     summary_df.set_index('search term', inplace=True)
@@ -201,118 +435,281 @@ def summarise_word_popularity(df, search_terms, all_case_study_count):
     return summary_df
 
 
-def plot_bar_from_df(df, y_col, title, x_axis_title, y_axis_title):
-    """Plot a functional, rather than a pretty, chart from a dataframe.
+@traced
+def count_cube_for(df, hits, funder_cols, list_of_uoas, max_matches):
+    """Count the case studies by term, place, funder and Unit of Assessment.
 
-    Pretty charts can be made in the "graphing for presentations code" repo in Github
+    :params: a dataframe of case studies, its hit matrix from find_terms_in_places, a list of
+             its funder cols, a list of units of assessment and the largest number of (term, place)
+             matches the summary of where terms were found needs a count for
+    :return: a CountCube, weighted by the sampling weight col if the dataframe has one
     """
-    ax = df.plot(y=y_col, kind='bar', legend=None)
-    for i, each in enumerate(df.index):
-        y_val = df.ix[each][y_col]
-        ax.text(i-0.3, y_val+0.2, int(y_val))
+    terms, places, hit_array = hits_to_array(hits)
+    funders = df[funder_cols].fillna(False).astype(bool).values
+    uoa_codes = get_uoa_ids(df['Unit of Assessment'], list_of_uoas).codes
 
-    plt.tick_params(top='off', bottom='off', left='off', right='off')
+    # A sample made by reduce_df_for_test.py is counted by its sampling weights
+    weights = df[SAMPLING_WEIGHT].values if SAMPLING_WEIGHT in df.columns else None
 
-    plt.title(title)
-    plt.xlabel(x_axis_title)
-    plt.ylabel(y_axis_title)
+    return build_count_cube(hit_array, terms, places, funders, funder_cols, uoa_codes, list_of_uoas, max_matches, weights)
 
-    ax.spines['left'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.spines['top'].set_visible(False)
 
-    # This provides more space around the chart to make it prettier
-    plt.tight_layout(True)
-    filename = title.replace(' ', '_')
-    plt.savefig(CHART_RESULT_STORE + filename + '.png', format='png', dpi=150)
+def counts_from_cube(cube, search_places):
+    """Take the counts behind each summary from a count cube.
 
-    return
+    :params: a CountCube and a list of search places (which may include 'anywhere')
+    :return: a tuple of the number of case studies, a dataframe counting the studies in each place by their
+             number of matches, a series counting the studies with search terms identified for each funder,
+             series counting the studies in each UoA (with search terms identified and all of them) and
+             a series counting the studies in which each term was found
+    """
+    all_case_study_count = cube.select(term=ALL_STUDIES, place=ANYWHERE, funder=ALL, uoa=ALL)
+
+    # The studies with any term in a place are split by their number of matches. Only the counts
+    # for 2 or more matches are in the cube, so the rest of the studies are put down as matching 1
+    matches = [member for member in cube.coords['term'] if is_matching_words(member)]
+    where_counts = cube.select(term=matches, place=search_places, funder=ALL, uoa=ALL)
+    where_counts.index = range(2, len(matches) + 2)
+    any_term_counts = cube.select(term=ANY_TERM, place=search_places, funder=ALL, uoa=ALL)
+    where_counts.loc[1] = any_term_counts - where_counts.sum()
+    where_counts.loc[0] = 0
+    where_counts = where_counts.sort_index()
+    where_counts.columns.name = None
+
+    funders = [member for member in cube.coords['funder'] if member != ALL]
+    funder_counts = cube.select(term=ANY_TERM, place=ANYWHERE, funder=funders, uoa=ALL)
+
+    uoas = [member for member in cube.coords['uoa'] if member != ALL]
+    uoa_term_found_counts = cube.select(term=ANY_TERM, place=ANYWHERE, funder=ALL, uoa=uoas)
+    uoa_all_counts = cube.select(term=ALL_STUDIES, place=ANYWHERE, funder=ALL, uoa=uoas)
+
+    terms = cube.coords['term'][:cube.coords['term'].index(ANY_TERM)]
+    popularity_counts = cube.select(term=terms, place=ANYWHERE, funder=ALL, uoa=ALL)
+
+    return all_case_study_count, where_counts, funder_counts, uoa_term_found_counts, uoa_all_counts, popularity_counts
+
+
+@traced
+def stream_analysis(filename, chunk_size, matcher, search_places, list_of_uoas, max_matches, export_writer):
+    """Run the analysis over the case studies a chunk of rows at a time.
+
+    Each chunk is searched and then thrown away, keeping only its count cube,
+    which are added up across the chunks. The case studies with search terms
+    identified are appended to the export file as each chunk is done
+    :params: a csv file of case studies, the number of rows in a chunk, a TermMatcher holding
+             the search terms, a list of search places, a list of units of assessment, the largest
+             number of matches to count studies by and the TableWriter to export the case studies
+             with search terms identified with
+    :return: a CountCube
+    """
+    cube = None
 
+    for chunk_number, df in enumerate(pd.read_csv(filename, chunksize=chunk_size)):
+        hits = find_terms_in_places(df, matcher, search_places, MATCHING_PROCESSES)
+        funder_cols = get_col_list(df, 'funder')
 
-def main():
-    # A list of the different parts of the case study (i.e. columns) in which
-    # we want to search. I've removed 'References to the research' from the list
-    # because it's too uncoupled from the actual case study content
-    possible_search_places = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+        chunk_cube = count_cube_for(df, hits, funder_cols, list_of_uoas, max_matches)
+        if chunk_number == 0:
+            cube = chunk_cube
+        else:
+            cube.add(chunk_cube)
 
-    # Get our search terms from policy_common_data
-    search_terms = SoftwareSearchTerms().data
+        # Limit to only rows where search term(s) was found, expand the hits into
+        # the wide found_in columns and add this chunk to the export
+        ids_term_identified = hits.index[hits.any(axis=1)]
+        df_term_identified = df[df['Case Study Id'].isin(ids_term_identified)][case_study_export_cols(df)]
+        df_term_identified = df_term_identified.join(hits_to_found_in_cols(hits.loc[ids_term_identified]), on='Case Study Id')
+        export_writer.write(df_term_identified)
 
-    # Import case study data
-    df = import_csv_to_df(DATAFILENAME)
+    return cube
 
-    # Import case studies by funder
-    # This is only used to create a list of funders
-    df_studies_by_funder = import_csv_to_df(STUDIES_BY_FUNDER)
-    # Create a list of the available funders.
-    # Easily done by taking the col names of df_studies_by_funder
-    # and removing the Case Study Id items
-    list_of_funders = list(df_studies_by_funder.columns)
-    list_of_funders.remove('Case Study Id')
 
-    # Import units of assessment from original xls
-    df_uoas = import_csv_to_df(UNITS_OF_ASSESSMENT)
-    # Create a list of the units of assessment
-    list_of_uoas = list(df_uoas['Unit of assessment'].str.lower())
-    list_of_uoas.sort()
+def render_charts_in_background(chart_jobs, chart_store):
+    """Hand charts to a separate process to draw, without waiting for it.
+
+    The process reads the summaries back from their CSV files, so they must be
+    written before this is called
+    :params: a list of chart jobs as described in charts.render_charts, and the dir to save the charts in
+    :return: the Popen of the chart process
+    """
+    charts_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'charts.py')
+
+    # Start the process in its own session, so it carries on once this one exits
+    return subprocess.Popen([sys.executable, charts_script, chart_store, json.dumps(chart_jobs)], start_new_session=True)
 
-    # Record length of original df and hence, number of all case studies
-    all_case_study_count = len(df)
 
-    # Go through the parts of the bid, and for each one look for the search word, record how
-    # many case studies were found to match, then add a new column to identify this location
-    # in the original dataframe
-    for word_to_search_for in search_terms:
-        for part_in_bid in possible_search_places:
-            df_cut = cut_to_specific_word(df, word_to_search_for.lower(), part_in_bid)
-            df = associate_new_data(df, df_cut)
+@traced
+def in_memory_analysis(datafilename, matcher, possible_search_places, list_of_funders, list_of_uoas, max_matches, result_store):
+    """Run the analysis over all the case studies at once.
 
-    # Get a list of all columns with data related to funders
+    The case studies with search terms identified are exported as a side effect
+    :params: a csv file of case studies, a TermMatcher holding the search terms, a list of search places,
+             a list of funders, a list of units of assessment, the largest number of matches to count
+             studies by and the dir to export to
+    :return: a CountCube
+    """
+    # Import only the case study data that the analysis needs. If text_store.py has
+    # stored the text of the current data, it's read from there rather than loaded
+    # into the dataframe. The rest of the columns are loaded at the end for the export
+    text_store = load_text_store(datafilename)
+    if text_store is not None and not text_store.has_places(possible_search_places):
+        text_store = None
+    text_cols = possible_search_places if text_store is None else []
+    weight_cols = [SAMPLING_WEIGHT] if SAMPLING_WEIGHT in pd.read_csv(datafilename, nrows=0).columns else []
+    df = import_csv_to_df(datafilename, ['Case Study Id', 'Unit of Assessment'] + text_cols + list_of_funders + weight_cols)
+
+    # Go through the parts of the bid once each, recording where each search word
+    # was found in a hit matrix. If corpus_index.py has indexed the current data,
+    # look the terms up instead. Terms that have been searched for in this version
+    # of the data before are served from the hit cache
+    hit_cache = load_hit_cache(corpus_hash_for(datafilename), df['Case Study Id'].values)
+    index = load_index_for_missing_terms(hit_cache, matcher, possible_search_places, datafilename)
+    hits = find_terms_in_places_cached(df, hit_cache, matcher, possible_search_places, index, text_store)
+    save_hit_cache(hit_cache)
+
+    # Get a list of all columns with data related to funders, and store them as booleans
     funder_cols = get_col_list(df, 'funder')
+    df = compact_funder_cols(df, funder_cols)
+
+    # Count the case studies by term, place, funder and UoA in one pass. Every
+    # summary is taken from these counts
+    cube = count_cube_for(df, hits, funder_cols, list_of_uoas, max_matches)
+
+    # Expand the hits of the identified case studies into the wide found_in columns
+    # for the export. Only if the full text is wanted is every column loaded
+    ids_term_identified = hits.index[hits.any(axis=1)]
+    df_export = import_csv_to_df(datafilename) if EXPORT_FULL_TEXT else df
+    df_term_identified = df_export[df_export['Case Study Id'].isin(ids_term_identified)][case_study_export_cols(df_export)]
+    df_term_identified = df_term_identified.join(hits_to_found_in_cols(hits.loc[ids_term_identified]), on='Case Study Id')
+    export_table(df_term_identified, result_store, CASE_STUDY_EXPORT, CASE_STUDY_EXPORT_FORMAT, index=EXPORT_FULL_TEXT)
+
+    return cube
+
+
+def load_funders(studies_by_funder):
+    """Create a list of the available funders.
 
-    # Get a list of all columns with data related to where a term was found
-    found_in_cols = get_col_list(df, 'found_in')
+    Easily done by taking the col names of the case studies by funder and removing the Case Study Id
+    :params: a csv file of case studies by funder, or None if the case studies have no funders
+    :return: a list of funder cols
+    """
+    if studies_by_funder is None:
+        return []
+
+    list_of_funders = list(pd.read_csv(studies_by_funder, nrows=0).columns)
+    list_of_funders.remove('Case Study Id')
+
+    return list_of_funders
+
+
+def load_uoas(units_of_assessment):
+    """Create a list of the units of assessment, and look up the main panel of each.
 
-    # For ease of calculation later, create a new column which is a summary of the
-    # other found in locations (i.e. found in anywhere)
-    df.loc[df[found_in_cols].notnull().any(1), 'any_term_found_in_anywhere'] = 'anywhere'
+    :params: a csv file of units of assessment and their main panels
+    :return: a sorted list of normalised UoA names, and a dict of UoA name to main panel
+    """
+    df_uoas = import_csv_to_df(units_of_assessment)
+    uoa_names = df_uoas['Unit of assessment'].map(normalise_uoa_name)
+
+    return sorted(uoa_names), dict(zip(uoa_names, df_uoas['Main panel']))
 
-    # Count the number of terms found in each record
-    df['search terms found'] = df[found_in_cols].apply(lambda x: x.count(), axis=1)
 
-    temp = df['search terms found'].unique().tolist()
-    temp.sort()
+@traced
+def summarise_cube(cube, search_terms, search_places, uoa_panels):
+    """Take every summary from a count cube.
 
+    :params: a CountCube, the list of search terms, a list of search places and a dict of UoA name to main panel
+    :return: a dict of summary name to summary dataframe
+    """
     # Add anywhere to the search places, because it's an addition that's not in
     # the original list
-    found_in_cols.append('any_term_found_in_anywhere')
-    possible_search_places.append('anywhere')
+    search_places = search_places + ['anywhere']
 
-    # Limit to only rows where search term(s) was found
-    df_term_identified = df.dropna(axis=0, subset=found_in_cols, how='all')
+    # Take each summary from the counts
+    counts = counts_from_cube(cube, search_places)
+    all_case_study_count, where_counts, funder_counts, uoa_term_found_counts, uoa_all_counts, popularity_counts = counts
 
-    # Summarise the data across search terms or where they were found
-    df_summary_terms = summarise_search_terms(df_term_identified, search_terms, possible_search_places, found_in_cols, all_case_study_count)
+    df_summary_uoas = summarise_uoas_from_counts(uoa_term_found_counts, uoa_all_counts, all_case_study_count)
 
-    # Get a summary of the data across funders
-    df_summary_funders = summarise_funders(df_term_identified, funder_cols, all_case_study_count)
+    return {'summary_of_where_terms_found': summarise_search_terms_from_counts(where_counts, search_terms,
+                                                                              search_places, all_case_study_count),
+            'summary_of_funders': summarise_funders_from_counts(funder_counts, all_case_study_count),
+            'summary_of_uoas': df_summary_uoas,
+            # Roll the UoAs up into their main panels
+            'summary_of_panels': summarise_panels(df_summary_uoas, uoa_panels, all_case_study_count),
+            'summary_of_word_popularity': summarise_word_popularity_from_counts(popularity_counts, all_case_study_count)}
 
-    # Get a summary of the data across UOAs
-    # NOTE: this uses the full dataframe not the df_term_identified one
-    df_summary_uoas = summarise_uoas(df, df_term_identified, list_of_uoas, all_case_study_count)
 
-    df_summary_popularity = summarise_word_popularity(df, search_terms, all_case_study_count)
+@traced
+def analyse_corpus(datafilename, studies_by_funder, units_of_assessment, result_store, matcher, search_terms,
+                   possible_search_places):
+    """Find the search terms in a corpus of case studies, and summarise and export the results.
+
+    :params: a csv file of case studies, a csv file of case studies by funder (or None), a csv file of
+             units of assessment, the dir to save the results in, a TermMatcher holding the search terms,
+             the list of search terms and a list of search places
+    :return: a dict of summary name to summary dataframe
+    """
+    list_of_funders = load_funders(studies_by_funder)
+    list_of_uoas, uoa_panels = load_uoas(units_of_assessment)
+
+    if CHUNK_SIZE is not None:
+        # Go through the case studies a chunk at a time, only keeping the counts behind the summaries
+        export_writer = TableWriter(result_store, CASE_STUDY_EXPORT, CASE_STUDY_EXPORT_FORMAT, index=EXPORT_FULL_TEXT)
+        try:
+            cube = stream_analysis(datafilename, CHUNK_SIZE, matcher, possible_search_places, list_of_uoas, len(search_terms),
+                                   export_writer)
+        except Exception:
+            export_writer.abort()
+            raise
+        export_writer.close()
+    else:
+        cube = in_memory_analysis(datafilename, matcher, possible_search_places, list_of_funders, list_of_uoas,
+                                  len(search_terms), result_store)
 
-    # Write results to CSV files
-    export_to_csv(df_term_identified, RESULT_STORE, 'only_case_studies_with_search_term_identified')
-    export_to_csv(df_summary_terms, RESULT_STORE, 'summary_of_where_terms_found')
-    export_to_csv(df_summary_funders, RESULT_STORE, 'summary_of_funders')
-    export_to_csv(df_summary_uoas, RESULT_STORE, 'summary_of_uoas')
-    export_to_csv(df_summary_popularity, RESULT_STORE, 'summary_of_word_popularity')
+    # Keep the counts, so other cross-tabs can be made from them without searching the case studies again
+    save_count_cube(cube, result_store + 'count_cube.pickle')
 
-    # Generate PNG charts from our results
-    plot_bar_from_df(df_summary_popularity, '% of all studies', 'Incidence of search words in REF 2014 case studies', '', '% of all case studies')
-    plot_bar_from_df(df_summary_funders, '% of all studies', 'Case studies by funder', '', '% of all case studies')
+    summaries = summarise_cube(cube, search_terms, possible_search_places, uoa_panels)
+
+    # Write results to CSV files, all at once
+    export_tables(summaries, result_store)
+
+    return summaries
+
+
+@traced
+def main():
+    # A list of the different parts of the case study (i.e. columns) in which
+    # we want to search. I've removed 'References to the research' from the list
+    # because it's too uncoupled from the actual case study content
+    possible_search_places = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+
+    # Get our search terms from policy_common_data, and compile them all into one matcher
+    search_terms = SoftwareSearchTerms().data
+    matcher = TermMatcher(search_terms)
+
+    summaries = analyse_corpus(DATAFILENAME, STUDIES_BY_FUNDER, UNITS_OF_ASSESSMENT, RESULT_STORE, matcher, search_terms,
+                               possible_search_places)
+    df_summary_popularity = summaries['summary_of_word_popularity']
+    df_summary_funders = summaries['summary_of_funders']
+
+    # Generate PNG charts from our results. matplotlib is only imported if they're drawn here
+    chart_jobs = [
+        {'csv': RESULT_STORE + 'summary_of_word_popularity.csv', 'y_col': '% of all studies',
+         'title': 'Incidence of search words in REF 2014 case studies', 'x_axis_title': '', 'y_axis_title': '% of all case studies'},
+        {'csv': RESULT_STORE + 'summary_of_funders.csv', 'y_col': '% of all studies',
+         'title': 'Case studies by funder', 'x_axis_title': '', 'y_axis_title': '% of all case studies'},
+    ]
+    if CHART_MODE == 'sync':
+        from charts import chart_spec, render_chart_batch
+        render_chart_batch([chart_spec(df_summary, job['y_col'], job['title'], job['x_axis_title'], job['y_axis_title'])
+                            for df_summary, job in zip([df_summary_popularity, df_summary_funders], chart_jobs)],
+                           CHART_RESULT_STORE)
+    elif CHART_MODE == 'deferred':
+        chart_process = render_charts_in_background(chart_jobs, CHART_RESULT_STORE)
+        if os.environ.get(PIPELINE_STAGE_ENV):
+            chart_process.wait()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Without pyarrow tables can only be exported as csv
+    pyarrow = None
+
+# Other global variables
+# The formats a table can be exported in, by file extension
+EXPORT_FORMATS = ['csv', 'csv.gz', 'parquet']
+# How many files are written at once by export_tables
+EXPORT_THREADS = 4
+
+
+def export_filename(location, filename, export_format='csv'):
+    """Find the file a table is exported to.
+
+    :params: the dir to export to, the name of the table and the export format
+    :return: a filename
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format ' + export_format + ', use one of ' + ', '.join(EXPORT_FORMATS))
+
+    return os.path.join(location, filename + '.' + export_format)
+
+
+class TableWriter(object):
+    """Exports a table, a chunk at a time if need be, replacing any earlier export in a single step.
+
+    The table is written to a temporary file next to the export, which is only
+    moved into place once the last chunk has been written, so anything reading
+    the export sees either the old table or the whole of the new one. Each chunk
+    is written as it arrives, as more lines of a CSV file or as a row group of a
+    parquet file, so only one chunk is held in memory at a time.
+    """
+
+    def __init__(self, location, filename, export_format='csv', index=False):
+        self.filename = export_filename(location, filename, export_format)
+        self.temp_filename = self.filename + '.tmp'
+        self.export_format = export_format
+        self.index = index
+        self.handle = None
+        self.parquet_writer = None
+        self.header = True
+
+    def write(self, df):
+        """Add a chunk of rows to the table.
+
+        :params: a dataframe with the same cols as the chunks before it
+        :return: nothing
+        """
+        if self.export_format == 'parquet':
+            self.write_row_group(df)
+            return
+
+        if self.handle is None:
+            if self.export_format == 'csv.gz':
+                self.handle = gzip.open(self.temp_filename, 'wt', newline='')
+            else:
+                self.handle = open(self.temp_filename, 'w', newline='')
+        df.to_csv(self.handle, index=self.index, header=self.header)
+        self.header = False
+
+    def write_row_group(self, df):
+        """Add a chunk of rows to a parquet table as a row group.
+
+        The types of the cols are taken from the first chunk, and the later
+        chunks are converted to them. pandas reads a col with no values in a
+        chunk as floats, whatever it holds in the rest of the table, so such
+        cols are held as nulls of the type of the col, which is text if the
+        first chunk has no values in it either
+        :params: a dataframe with the same cols as the chunks before it
+        :return: nothing
+        """
+        if pyarrow is None:
+            raise ValueError('Exporting to parquet needs pyarrow')
+
+        empty_cols = [col for col in df.columns if str(df[col].dtype) != 'category' and df[col].isnull().all()]
+        if empty_cols:
+            df = df.copy()
+            df[empty_cols] = df[empty_cols].astype(object)
+
+        if self.parquet_writer is None:
+            table = pyarrow.Table.from_pandas(df, preserve_index=self.index)
+            schema = table.schema
+            for col in empty_cols:
+                schema = schema.set(schema.get_field_index(col), pyarrow.field(col, pyarrow.string()))
+            table = table.cast(schema)
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(self.temp_filename, schema, compression='snappy')
+        else:
+            table = pyarrow.Table.from_pandas(df, schema=self.parquet_writer.schema, preserve_index=self.index)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        """Finish the table and move it into place.
+
+        :return: the filename of the export
+        """
+        if self.handle is None and self.parquet_writer is None:
+            # No chunks were written, so the export is empty
+            self.write(pd.DataFrame())
+        if self.export_format == 'parquet':
+            self.parquet_writer.close()
+        else:
+            self.handle.close()
+
+        os.replace(self.temp_filename, self.filename)
+
+        return self.filename
+
+    def abort(self):
+        """Give up on the table, leaving any earlier export in place."""
+        if self.handle is not None:
+            self.handle.close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+
+
+def export_table(df, location, filename, export_format='csv', index=True):
+    """Exports a df, replacing any earlier export in a single step.
+
+    :params: a df, the dir to save it in, the name of the table, the export format and whether to save the index
+    :return: the filename of the export
+    """
+    writer = TableWriter(location, filename, export_format, index)
+    try:
+        writer.write(df)
+        return writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+
+def export_tables(tables, location, export_format='csv', max_workers=EXPORT_THREADS):
+    """Exports several dfs at once, each replacing its earlier export in a single step.
+
+    :params: a dict of table name to df, the dir to save them in, the export format,
+             and how many to write at once
+    :return: a dict of table name to the filename of its export
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((name, executor.submit(export_table, df, location, name, export_format))
+                       for name, df in tables.items())
+
+    return dict((name, future.result()) for name, future in futures.items())
+
+
+def find_export(location, filename):
+    """Find the most recent export of a table, in whichever format it was exported.
+
+    :params: the dir the table was exported to and the name of the table
+    :return: a filename, or None if the table hasn't been exported
+    """
+    exports = [export_filename(location, filename, export_format) for export_format in EXPORT_FORMATS]
+    exports = [export for export in exports if os.path.exists(export)]
+    if not exports:
+        return None
+
+    return max(exports, key=os.path.getmtime)
+
+
+def read_export(filename):
+    """Imports an exported table into a Pandas dataframe.
+
+    :params: a filename from export_table or find_export
+    :return: a df
+    """
+    if filename.endswith('.parquet'):
+        if pyarrow is None:
+            raise ValueError('Reading a parquet export needs pyarrow')
+        return pyarrow.parquet.read_table(filename).to_pandas()
+
+    return pd.read_csv(filename)
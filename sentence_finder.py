@@ -1,40 +1,37 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from pandas import ExcelWriter
-import numpy as np
-import matplotlib.pyplot as plt
-import math
 import string
 import re
 
-from search_terms import SEARCH_TERM_LIST
+# Add search terms from policy_common_data submodule repo
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "lib", "policy_common_data"))
+from commondata.softwaresearchterms import SoftwareSearchTerms
+
+from corpus_index import INDEX_FILENAME, load_index
+from corpus_cache import read_cached_csv
+from text_store import load_text_store
+from result_export import export_table, find_export, read_export
+from term_matching import TermMatcher
+from instrumentation import traced
 
 # Other global variables
-DATAFILENAME = "outputs/only_case_studies_with_search_term_identified.csv"
+CASE_STUDY_EXPORT = "only_case_studies_with_search_term_identified"
+CORPUS_FILENAME = "input/generated/all_ref_case_study_data.csv"
 RESULT_STORE = "outputs/"
 CHART_RESULT_STORE = "outputs/charts/"
+# How many characters either side of a term are kept in batch mode
+CONTEXT_WINDOW = 70
+# How many case studies each worker process handles at a time in batch mode
+BATCH_CHUNK_SIZE = 500
 
+# Used to remove punctuation from a string
+PUNCTUATION_REGEX = re.compile('[%s]' % re.escape(string.punctuation))
 
-def import_csv_to_df(filename):
-    """
-    Imports a csv file into a Pandas dataframe
-    :params: a csv file
-    :return: a df
-    """
-    
-    return pd.read_csv(filename)
-
-
-def export_to_csv(df, location, filename):
-    """
-    Exports a df to a csv file
-    :params: a df and a location in which to save it
-    :return: nothing, saves a csv
-    """
-
-    return df.to_csv(location + filename + '.csv')
 
 def term_of_interest(terms):
 
@@ -49,7 +46,8 @@ def term_of_interest(terms):
     return choice
 
 
-def find_terms_and_context(df, term_of_focus, search_places):
+@traced
+def find_terms_and_context(df, term_of_focus, search_places, corpus_index=None):
 
     # Find cols that have the term_of_focus in them
     matching = [s for s in df.columns if term_of_focus in s]
@@ -62,7 +60,11 @@ def find_terms_and_context(df, term_of_focus, search_places):
 
     
     # Limit df to just the rows where a term_of_focus has been found
-    focus_df = df.dropna(subset=[cols_to_keep], how='all', axis=0)
+    focus_df = df.dropna(subset=cols_to_keep, how='all', axis=0)
+
+    term_offsets = {}
+    if corpus_index is not None and corpus_index.can_look_up(term_of_focus):
+        term_offsets = corpus_index.find_term_offsets(term_of_focus)
 
     # Go through each row of the df
     for index, row in focus_df.iterrows():
@@ -76,9 +78,8 @@ def find_terms_and_context(df, term_of_focus, search_places):
                 offset = 70
                 # Get the actual text
                 whole_string = row[current]
-                # The next two lines remove punctionation from the string
-                regex = re.compile('[%s]' % re.escape(string.punctuation))
-                cleaned_string = regex.sub(' ', whole_string)
+                # Remove punctuation from the string
+                cleaned_string = PUNCTUATION_REGEX.sub(' ', whole_string)
                 # Now find how many times the term appears in the sentence
                 # the split allows us to find only the word bracketed by spaces
                 how_many = cleaned_string.split().count(term_of_focus)
@@ -86,7 +87,13 @@ def find_terms_and_context(df, term_of_focus, search_places):
                 print()
                 print(term_of_focus + ' found in ' + current + ' ' + str(how_many) + ' times')
                 print()
-                start_index = whole_string.find(term_of_focus)
+                # If the corpus has been indexed, jump straight to where the term
+                # is, otherwise search for it in the text
+                offsets = term_offsets.get((row['Case Study Id'], current))
+                if offsets:
+                    start_index = offsets[0]
+                else:
+                    start_index = whole_string.find(term_of_focus)
                 end_index = start_index + len(term_of_focus)
                 print('...' + whole_string[(start_index-offset):(end_index+offset)] + '...')
 #                print(str(start_index) + ' ' + str(end_index))
@@ -97,6 +104,79 @@ def find_terms_and_context(df, term_of_focus, search_places):
     return
 
 
+def extract_contexts(df, matcher, search_places, window=CONTEXT_WINDOW, text_store=None):
+    """Find every occurrence of every search term, with the text around it.
+
+    Each part of each case study is scanned once for all the terms
+    :params: a dataframe of case studies, a TermMatcher holding the search terms, a list of
+             search places, how many characters either side of a term to keep, and optionally
+             a TextStore to read the text from (the dataframe then only needs the Case Study Id)
+    :return: a dataframe with a row for each occurrence, giving the Case Study Id, place,
+             term, offset of the term in the text and a snippet of the text around it
+    """
+    if text_store is not None:
+        rows_in_store = text_store.rows_for(df['Case Study Id'])
+
+    rows = []
+    for place in search_places:
+        texts = df[place] if text_store is None else text_store.texts(place, rows_in_store)
+        for study_id, text in zip(df['Case Study Id'], texts):
+            for offset, term in matcher.iter_matches(text):
+                snippet = text[max(offset - window, 0):offset + len(term) + window]
+                rows.append((study_id, place, term, offset, snippet))
+
+    return pd.DataFrame(rows, columns=['Case Study Id', 'place', 'term', 'offset', 'snippet'])
+
+
+@traced
+def extract_contexts_in_parallel(df, matcher, search_places, window=CONTEXT_WINDOW,
+                                 chunk_size=BATCH_CHUNK_SIZE, processes=None, text_store=None):
+    """Find every occurrence of every search term, splitting the case studies across processes.
+
+    :params: as extract_contexts, plus how many case studies to hand to a process at a time
+             and optionally the number of processes (defaults to one per CPU). A text store is
+             opened again in each process, so they all read the same pages of the text file
+    :return: a dataframe as from extract_contexts, in order of Case Study Id, place and offset
+    """
+    chunks = [df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(extract_contexts, chunks, [matcher] * len(chunks),
+                                    [search_places] * len(chunks), [window] * len(chunks), [text_store] * len(chunks)))
+
+    contexts = pd.concat(results, ignore_index=True)
+    contexts['place'] = pd.Categorical(contexts['place'], categories=search_places, ordered=True)
+    # A stable sort, so contexts at the same offset keep the order they were found in
+    contexts.sort_values(['Case Study Id', 'place', 'offset'], kind='mergesort', inplace=True)
+    contexts['place'] = contexts['place'].astype(str)
+
+    return contexts.reset_index(drop=True)
+
+
+@traced
+def batch_main():
+    """
+    Extract every search term from every case study without asking which term to look for
+
+    The results are saved in keywords_in_context.csv rather than printed
+    """
+
+    possible_search_places = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+
+    # Import only the parts of the case study data that are searched. If text_store.py
+    # has stored the text of the current data, only the ids are needed
+    text_store = load_text_store(CORPUS_FILENAME)
+    if text_store is not None and not text_store.has_places(possible_search_places):
+        text_store = None
+    df = read_cached_csv(CORPUS_FILENAME, ['Case Study Id'] + (possible_search_places if text_store is None else []))
+
+    matcher = TermMatcher(SoftwareSearchTerms().data)
+
+    contexts = extract_contexts_in_parallel(df, matcher, possible_search_places, text_store=text_store)
+
+    export_table(contexts, RESULT_STORE, 'keywords_in_context', index=False)
+
+
+@traced
 def main():
     """
     Main function to run program
@@ -111,14 +191,34 @@ def main():
     # because it's too uncoupled from the actual case study content
     possible_search_places = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
 
-    # Import case study data
-    df = import_csv_to_df(DATAFILENAME)
+    # Import case study data. Unless ref_case_studies.py exported the full text,
+    # the export only has the case study ids, so get the text from the text store,
+    # or from the corpus if the store isn't up to date
+    export = find_export(RESULT_STORE, CASE_STUDY_EXPORT)
+    if export is None:
+        raise FileNotFoundError('There is no ' + CASE_STUDY_EXPORT + ' export in ' + RESULT_STORE +
+                                ', run ref_case_studies.py first')
+    df = read_export(export)
+    missing_places = [place for place in possible_search_places if place not in df.columns]
+    text_store = load_text_store(CORPUS_FILENAME) if missing_places else None
+    if text_store is not None and text_store.has_places(missing_places):
+        rows = text_store.rows_for(df['Case Study Id'])
+        for place in missing_places:
+            df[place] = list(text_store.texts(place, rows))
+    elif missing_places:
+        df = df.merge(read_cached_csv(CORPUS_FILENAME, ['Case Study Id'] + missing_places), on='Case Study Id', how='left')
     
-    term_of_focus = term_of_interest(SEARCH_TERM_LIST)
+    term_of_focus = term_of_interest(SoftwareSearchTerms().data)
 
-    find_terms_and_context(df, term_of_focus, possible_search_places)
+    # Use the index built by corpus_index.py, if it's up to date
+    corpus_index = load_index(INDEX_FILENAME, CORPUS_FILENAME)
+
+    find_terms_and_context(df, term_of_focus, possible_search_places, corpus_index)
     
 
 
 if __name__ == '__main__':
-    main()
+    if '--batch' in sys.argv[1:]:
+        batch_main()
+    else:
+        main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import re
+
+
+def build_term_trie(search_terms):
+    """Build a character trie from a list of search terms.
+
+    :params: a list of search terms
+    :return: a nested dict keyed on characters, with '' marking the end of a term
+    """
+    trie = {}
+    for term in search_terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    return trie
+
+
+def trie_to_regex(node):
+    """Convert a trie into a regex that matches any term in it.
+
+    Shared prefixes are only written out once, so the regex engine walks down
+    the trie rather than trying every term in turn. Optional tails are greedy,
+    so the longest term at a position is tried first.
+
+    :params: a trie from build_term_trie
+    :return: a regex string
+    """
+    alternatives = [re.escape(char) + trie_to_regex(node[char]) for char in sorted(node) if char]
+    if not alternatives:
+        return ''
+
+    if len(alternatives) == 1 and '' not in node:
+        return alternatives[0]
+
+    pattern = '(?:' + '|'.join(alternatives) + ')'
+    if '' in node:
+        pattern += '?'
+
+    return pattern
+
+
+def is_boundary(text, index):
+    """Check whether a regex word boundary (\\b) falls at index in text.
+
+    :params: a string and a position in it
+    :return: True if \\b would match at that position
+    """
+    before = index > 0 and (text[index-1].isalnum() or text[index-1] == '_')
+    after = index < len(text) and (text[index].isalnum() or text[index] == '_')
+
+    return before != after
+
+
+def restore_term_matcher(terms, pattern, implied):
+    """Rebuild a TermMatcher that has been handed to another process, without building its trie again.
+
+    :params: the terms, regex string and implied terms of a TermMatcher
+    :return: a TermMatcher
+    """
+    matcher = TermMatcher.__new__(TermMatcher)
+    matcher.terms = terms
+    matcher.pattern = re.compile(pattern)
+    matcher.implied = implied
+
+    return matcher
+
+
+class TermMatcher(object):
+    """All search terms compiled into one automaton.
+
+    Scanning a piece of text once reports every search term found in it,
+    with the same word boundary rules as searching for r'\\b' + term + r'\\b'
+    one term at a time.
+    """
+
+    def __init__(self, search_terms):
+        # Keep the order of the original list, but lose any duplicates
+        self.terms = list(dict.fromkeys(term.lower() for term in search_terms))
+
+        # The lookahead lets matches overlap, so a term starting inside another
+        # term (e.g. 'source code' inside 'open source code') is still found
+        self.pattern = re.compile(r'\b(?=(' + trie_to_regex(build_term_trie(self.terms)) + r')\b)')
+
+        # The regex only reports the longest term at each position, so record
+        # which shorter terms are implied by it (e.g. 'open' by 'open source')
+        self.implied = {}
+        for term in self.terms:
+            self.implied[term] = [shorter for shorter in self.terms
+                                  if shorter != term and term.startswith(shorter) and is_boundary(term, len(shorter))]
+
+    def __reduce__(self):
+        # Send the regex built from the trie and the implied terms rather than the
+        # compiled pattern, so the matcher can be handed to worker processes cheaply
+        # and the trie is only ever built once
+        return (restore_term_matcher, (self.terms, self.pattern.pattern, self.implied))
+
+    def iter_matches(self, text):
+        """Yield every occurrence of every search term in text.
+
+        :params: a string
+        :return: a generator of (offset, term) tuples in order of offset
+        """
+        if not isinstance(text, str):
+            return
+
+        for match in self.pattern.finditer(text):
+            term = match.group(1)
+            yield match.start(), term
+            for shorter in self.implied[term]:
+                yield match.start(), shorter
+
+    def find_terms(self, text):
+        """Find which search terms appear in text.
+
+        :params: a string
+        :return: a set of the search terms found
+        """
+        return set(term for _, term in self.iter_matches(text))
+
+    def find_terms_in_column(self, series):
+        """Scan a column of text once, finding the search terms in every cell.
+
+        :params: a series of strings
+        :return: a series of sets of search terms, with the same index
+        """
+        return series.map(self.find_terms)
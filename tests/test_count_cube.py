@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import ref_case_studies
+from term_matching import TermMatcher
+from count_cube import ALL, ALL_STUDIES, ANYWHERE, SAMPLING_WEIGHT, load_count_cube
+
+# Other global variables
+UNITS_OF_ASSESSMENT = os.path.join(REPO_DIR, 'input', 'raw', 'units_of_assessment.csv')
+SEARCH_TERMS = ['software', 'open source', 'source code', 'code', 'data', 'python']
+SEARCH_PLACES = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+FUNDER_COLS = ['funder_epsrc', 'funder_mrc', 'funder_wellcome']
+WORDS = ['software', 'open', 'source', 'code', 'data', 'python', 'the', 'research', 'impact', 'of', 'a']
+# Weights like those of a sample made by reduce_df_for_test.py, which aren't whole numbers
+WEIGHTS = [1, 10 / 3, 2.5, 1.25, 7 / 3]
+
+
+def write_weighted_corpus(location, case_study_count, seed=0):
+    """Write a synthetic weighted sample of case studies, and its funders.
+
+    :params: the dir to write the csv files in, the number of case studies and a random seed
+    :return: the filenames of the case studies and of the case studies by funder
+    """
+    rng = np.random.RandomState(seed)
+    uoa_names = list(pd.read_csv(UNITS_OF_ASSESSMENT)['Unit of assessment'].str.strip())
+
+    df = pd.DataFrame({'Case Study Id': np.arange(1, case_study_count + 1)})
+    df['Unit of Assessment'] = rng.choice(uoa_names, size=case_study_count)
+    for place in SEARCH_PLACES:
+        df[place] = [' '.join(rng.choice(WORDS, size=20)) for _ in range(case_study_count)]
+    for col in FUNDER_COLS:
+        # Funders are True where linked to a case study and empty elsewhere, as in the real data
+        df[col] = np.where(rng.rand(case_study_count) < 0.3, True, None)
+    df[SAMPLING_WEIGHT] = rng.choice(WEIGHTS, size=case_study_count)
+
+    datafilename = os.path.join(location, 'all_ref_case_study_data.csv')
+    df.to_csv(datafilename, index=False)
+    studies_by_funder = os.path.join(location, 'list_of_studies_by_council.csv')
+    df[['Case Study Id'] + FUNDER_COLS].to_csv(studies_by_funder, index=False)
+
+    return datafilename, studies_by_funder
+
+
+class TestWeightedStreaming(unittest.TestCase):
+    """A weighted sample analysed a chunk at a time must give the same summaries as when analysed at once."""
+
+    def setUp(self):
+        # The caches are written relative to the working dir, so work in a dir that is thrown away afterwards
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp()
+        os.chdir(self.work_dir)
+        self.chunk_size = ref_case_studies.CHUNK_SIZE
+        self.datafilename, self.studies_by_funder = write_weighted_corpus(self.work_dir, 500)
+
+    def tearDown(self):
+        ref_case_studies.CHUNK_SIZE = self.chunk_size
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir)
+
+    def analyse(self, chunk_size):
+        """Analyse the corpus, streaming it chunk_size rows at a time (or all at once for None)."""
+        ref_case_studies.CHUNK_SIZE = chunk_size
+        result_store = os.path.join(self.work_dir, 'outputs_' + str(chunk_size)) + os.sep
+        os.makedirs(result_store)
+        summaries = ref_case_studies.analyse_corpus(self.datafilename, self.studies_by_funder, UNITS_OF_ASSESSMENT,
+                                                    result_store, TermMatcher(SEARCH_TERMS), SEARCH_TERMS, SEARCH_PLACES)
+
+        return summaries, load_count_cube(result_store + 'count_cube.pickle')
+
+    def test_streamed_summaries_match_in_memory(self):
+        in_memory, _ = self.analyse(None)
+        for chunk_size in [7, 100]:
+            streamed, _ = self.analyse(chunk_size)
+            for name in in_memory:
+                self.assertEqual(streamed[name].to_csv(), in_memory[name].to_csv(),
+                                 name + ' differs when streamed ' + str(chunk_size) + ' rows at a time')
+
+    def test_weighted_total(self):
+        weights = pd.read_csv(self.datafilename)[SAMPLING_WEIGHT]
+        for chunk_size in [None, 7]:
+            _, cube = self.analyse(chunk_size)
+            self.assertEqual(cube.select(term=ALL_STUDIES, place=ANYWHERE, funder=ALL, uoa=ALL), int(round(weights.sum())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import mmap
+import pickle
+import numpy as np
+import pandas as pd
+
+from corpus_cache import file_fingerprint
+
+# Other global variables
+DATAFILENAME = "input/generated/all_ref_case_study_data.csv"
+TEXT_STORE = "input/generated/text_store/"
+TEXT_FILENAME = "text.bin"
+INDEX_FILENAME = "index.pickle"
+
+# The parts of the case study that are stored. These are the same parts
+# that ref_case_studies.py searches in
+STORED_PLACES = ['Title', 'Summary of the impact', 'Underpinning research', 'Details of the impact']
+
+# How many rows of the case studies are read at a time when the store is built
+CHUNK_SIZE = 1000
+
+
+def build_text_store(filename, places=STORED_PLACES, store_dir=TEXT_STORE, chunk_size=CHUNK_SIZE):
+    """Write the text of some parts of the case studies into a single file, and index where each part is in it.
+
+    The text is written as UTF-8 one part of one case study after another, a
+    chunk of case studies at a time. The index records the Case Study Ids and,
+    for each case study and place, the byte offset and length of its text (a
+    length of -1 for a part with no text). The index is written last, and any
+    old index is removed first, so a store that is being rebuilt is never read
+    :params: a csv file of case studies, a list of the columns to store, the dir to store them in
+             and how many rows to read at a time
+    :return: nothing, saves the text and its index
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    text_filename = os.path.join(store_dir, TEXT_FILENAME)
+    index_filename = os.path.join(store_dir, INDEX_FILENAME)
+
+    source_fingerprint = file_fingerprint(filename)
+    ids = []
+    offsets = []
+    lengths = []
+    position = 0
+    with open(text_filename + '.tmp', 'wb') as f:
+        for df in pd.read_csv(filename, usecols=['Case Study Id'] + places, dtype={place: str for place in places},
+                              chunksize=chunk_size):
+            chunk_offsets = np.full((len(df), len(places)), position, dtype=np.int64)
+            chunk_lengths = np.full((len(df), len(places)), -1, dtype=np.int64)
+            for row, texts in enumerate(zip(*[df[place].values for place in places])):
+                for place_index, text in enumerate(texts):
+                    if not isinstance(text, str):
+                        continue
+                    data = text.encode('utf-8')
+                    f.write(data)
+                    chunk_offsets[row, place_index] = position
+                    chunk_lengths[row, place_index] = len(data)
+                    position += len(data)
+            ids.append(df['Case Study Id'].values)
+            offsets.append(chunk_offsets)
+            lengths.append(chunk_lengths)
+
+    index = {'source_fingerprint': source_fingerprint, 'places': list(places),
+             'ids': np.concatenate(ids) if ids else np.array([], dtype=np.int64),
+             'offsets': np.concatenate(offsets) if offsets else np.zeros((0, len(places)), dtype=np.int64),
+             'lengths': np.concatenate(lengths) if lengths else np.zeros((0, len(places)), dtype=np.int64)}
+
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+    os.replace(text_filename + '.tmp', text_filename)
+    with open(index_filename + '.tmp', 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(index_filename + '.tmp', index_filename)
+
+
+class TextStore(object):
+    """The text of the case studies, memory-mapped from the file written by build_text_store.
+
+    The text is never read into memory as a whole. Each part of a case study is
+    a slice of the mapped file, and the pages of the file are shared by every
+    process that opens the store, so worker processes can be handed the store
+    (which is pickled as its dir, and opened again in the worker) rather than
+    a copy of the text.
+    """
+
+    def __init__(self, store_dir, index):
+        self.store_dir = store_dir
+        self.places = index['places']
+        self.place_index = {place: i for i, place in enumerate(self.places)}
+        self.ids = index['ids']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.row_index = {study_id: row for row, study_id in enumerate(self.ids)}
+
+        with open(os.path.join(store_dir, TEXT_FILENAME), 'rb') as f:
+            # An empty file can't be mapped
+            self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+    def __reduce__(self):
+        return (open_text_store, (self.store_dir,))
+
+    def has_places(self, places):
+        """Check whether every one of a list of places is stored."""
+        return set(places) <= set(self.places)
+
+    def rows_for(self, study_ids):
+        """Find where each of a list of case studies is in the store.
+
+        :params: a list or series of Case Study Ids
+        :return: an array of row positions
+        """
+        try:
+            return np.array([self.row_index[study_id] for study_id in study_ids], dtype=np.int64)
+        except KeyError as err:
+            raise KeyError('Case study ' + str(err.args[0]) + ' is not in the text store in ' + self.store_dir)
+
+    def view(self, row, place):
+        """Get the text of one part of one case study, without copying it.
+
+        :params: a row position from rows_for and a place
+        :return: a memoryview of the UTF-8 text, or None if the part has no text
+        """
+        place_index = self.place_index[place]
+        length = self.lengths[row, place_index]
+        if length < 0:
+            return None
+        offset = self.offsets[row, place_index]
+
+        return memoryview(self.text)[offset:offset + length]
+
+    def get_text(self, row, place):
+        """Get the text of one part of one case study.
+
+        :params: a row position from rows_for and a place
+        :return: a string, or None if the part has no text
+        """
+        view = self.view(row, place)
+        if view is None:
+            return None
+
+        return str(view, 'utf-8')
+
+    def texts(self, place, rows):
+        """Go through the text of one part of several case studies, one at a time.
+
+        Only the text of the case study being looked at is held as a string
+        :params: a place and a list of row positions from rows_for
+        :return: a generator of strings, with None for a case study with no text in that place
+        """
+        for row in rows:
+            yield self.get_text(row, place)
+
+
+def open_text_store(store_dir=TEXT_STORE):
+    """Open a text store, without checking whether it is up to date.
+
+    :params: the dir of a store written by build_text_store
+    :return: a TextStore
+    """
+    with open(os.path.join(store_dir, INDEX_FILENAME), 'rb') as f:
+        index = pickle.load(f)
+
+    return TextStore(store_dir, index)
+
+
+def load_text_store(source_filename, store_dir=TEXT_STORE):
+    """Open a text store if it is still up to date.
+
+    :params: the csv file the store was built from and the dir of the store
+    :return: a TextStore, or None if there is no store or the csv file has changed since it was built
+    """
+    index_filename = os.path.join(store_dir, INDEX_FILENAME)
+    if not os.path.exists(index_filename):
+        return None
+
+    with open(index_filename, 'rb') as f:
+        index = pickle.load(f)
+
+    if index['source_fingerprint'] != file_fingerprint(source_filename):
+        return None
+
+    return TextStore(store_dir, index)
+
+
+def main():
+    # Store the parts of the case study data written by merge_studies_with_funder.py
+    # that are searched, so the later stages can read them without parsing the csv file
+    build_text_store(DATAFILENAME)
+
+
+if __name__ == '__main__':
+    main()